@@ -3,75 +3,326 @@ from kfp.dsl import Input, Output, Artifact
 
 
 @dsl.component(base_image="python:3.11", packages_to_install=["requests"])
-def download_ml25m_data(output_path_one: Output[Artifact]):
+def download_ml25m_data(output_path_one: Output[Artifact], url: str = 'https://files.grouplens.org/datasets/movielens/ml-25m.zip',
+                        expected_md5: str = '', md5_url: str = 'https://files.grouplens.org/datasets/movielens/ml-25m.zip.md5',
+                        cache_dir: str = '/tmp/ml-25m-cache', connections: int = 8,
+                        chunk_size_mb: int = 1, timeout: int = 60, max_retries: int = 5, verify_tls: bool = True):
+    """
+    Downloads url with `connections` parallel HTTP range requests, falling back to a single stream when the server
+    does not accept ranges. Parts are kept under cache_dir/partial/<ETag> and resumed from their current size after a
+    failure. Downloads that match the expected MD5 are stored under cache_dir/blobs/<md5>.zip, indexed by ETag, so a
+    rerun copies from the cache without downloading. Without an expected MD5 nothing is cached. Mount cache_dir on a
+    volume to keep it between runs.
+    :param expected_md5: str, checked against the downloaded file, and used to look up the cache without any request
+    :param md5_url: str, .md5 file the expected MD5 is read from when expected_md5 is empty (empty to skip it)
+    """
+    import hashlib
+    import os
+    import re
+    import shutil
+    import time
+    from concurrent.futures import ThreadPoolExecutor
     import requests
-    url = 'https://files.grouplens.org/datasets/movielens/ml-25m.zip'
-    response = requests.get(url, stream=True, verify=False, timeout=60)
-    print(output_path_one.path)
-    with open(output_path_one.path, 'wb') as file: 
-        for chunk in response.iter_content(chunk_size=1024*1024):  # D
-            if chunk:
-                file.write(chunk)
-
 
-@dsl.component(base_image="python:3.11")            
-def unzip_data(input_path: Input[Artifact], ratings_output_path: Output[Artifact], movies_output_path: Output[Artifact]):
+    chunk_size = chunk_size_mb * 1024 * 1024
+    blobs_dir = os.path.join(cache_dir, 'blobs')
+    etags_dir = os.path.join(cache_dir, 'etags')
+    os.makedirs(blobs_dir, exist_ok=True)
+    os.makedirs(etags_dir, exist_ok=True)
+
+    def from_cache(md5):
+        blob = os.path.join(blobs_dir, f'{md5}.zip')
+        if not os.path.exists(blob):
+            return False
+        shutil.copyfile(blob, output_path_one.path)
+        print(f"Cache hit for {url}: {blob}")
+        return True
+
+    if not expected_md5 and md5_url:
+        md5_response = requests.get(md5_url, verify=verify_tls, timeout=timeout)
+        md5_response.raise_for_status()
+        match = re.search(r'\b[0-9a-fA-F]{32}\b', md5_response.text)
+        if match is None:
+            raise ValueError(f"No MD5 digest found in {md5_url}: {md5_response.text[:200]!r}")
+        expected_md5 = match.group(0)
+    expected_md5 = expected_md5.lower()
+
+    if expected_md5 and from_cache(expected_md5):
+        return
+
+    head = requests.head(url, allow_redirects=True, verify=verify_tls, timeout=timeout)
+    head.raise_for_status()
+    etag = re.sub(r'[^A-Za-z0-9._-]', '', head.headers.get('ETag', ''))
+    size = int(head.headers.get('Content-Length', 0))
+    accepts_ranges = head.headers.get('Accept-Ranges', '').lower() == 'bytes' and size > 0
+
+    if etag and not expected_md5 and os.path.exists(os.path.join(etags_dir, etag)):
+        with open(os.path.join(etags_dir, etag)) as f:
+            if from_cache(f.read().strip()):
+                return
+
+    n_parts = max(1, min(connections, size)) if accepts_ranges else 1
+    part_size = -(-size // n_parts) if accepts_ranges else 0
+    ranges = [(i * part_size, min(size, (i + 1) * part_size) - 1) for i in range(n_parts)] if accepts_ranges else [None]
+    # Parts of a previous attempt are only reused while the ETag, the size and the range layout are unchanged
+    partial_dir = os.path.join(cache_dir, 'partial', f"{etag or hashlib.md5(url.encode()).hexdigest()}-{size}-{n_parts}")
+    os.makedirs(partial_dir, exist_ok=True)
+
+    def fetch(i):
+        part_path = os.path.join(partial_dir, f'part-{i:03d}')
+        if os.path.exists(part_path) and (ranges[i] is None or os.path.getsize(part_path) > ranges[i][1] - ranges[i][0] + 1):
+            os.remove(part_path)
+        start = time.perf_counter()
+        received = 0
+        for attempt in range(max_retries + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {}
+            if ranges[i] is not None:
+                first, last = ranges[i]
+                if first + offset > last:
+                    break
+                headers['Range'] = f'bytes={first + offset}-{last}'
+            try:
+                with requests.get(url, headers=headers, stream=True, verify=verify_tls, timeout=timeout) as response:
+                    response.raise_for_status()
+                    if headers and response.status_code != 206:
+                        raise IOError(f"{url} ignored the range request for part {i}")
+                    with open(part_path, 'ab' if headers else 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                            received += len(chunk)
+                if not headers:
+                    break
+                # A short read of a range does not raise, the next attempt checks the part size and resumes it
+            except (requests.RequestException, IOError) as e:
+                if attempt == max_retries:
+                    raise
+                print(f"Part {i} failed after {received} bytes ({e}), retrying")
+                time.sleep(min(2 ** attempt, 30))
+        elapsed = time.perf_counter() - start
+        print(f"Part {i}: {received / 2**20:.1f} MB in {elapsed:.1f}s ({received / 2**20 / max(elapsed, 1e-9):.1f} MB/s)")
+        return received
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_parts) as pool:
+        received = sum(pool.map(fetch, range(n_parts)))
+    elapsed = time.perf_counter() - start
+    print(f"Downloaded {received / 2**20:.1f} MB from {url} in {elapsed:.1f}s "
+          f"({received / 2**20 / max(elapsed, 1e-9):.1f} MB/s, {n_parts} connection(s))")
+
+    md5 = hashlib.md5()
+    with open(output_path_one.path, 'wb') as output:
+        for i in range(n_parts):
+            with open(os.path.join(partial_dir, f'part-{i:03d}'), 'rb') as part:
+                for chunk in iter(lambda: part.read(chunk_size), b''):
+                    md5.update(chunk)
+                    output.write(chunk)
+    digest = md5.hexdigest()
+    shutil.rmtree(partial_dir)
+    if size > 0 and os.path.getsize(output_path_one.path) != size:
+        raise ValueError(f"Downloaded {os.path.getsize(output_path_one.path)} bytes, expected {size}")
+    if expected_md5 and digest != expected_md5:
+        raise ValueError(f"MD5 of {url} is {digest}, expected {expected_md5}")
+    print(f"MD5: {digest}")
+
+    # Only a download checked against a known MD5 is cached, anything else could become a permanent bad cache hit
+    if not expected_md5:
+        print("No expected MD5, not caching the download")
+        return
+    blob = os.path.join(blobs_dir, f'{digest}.zip')
+    shutil.copyfile(output_path_one.path, blob + '.tmp')
+    os.replace(blob + '.tmp', blob)
+    if etag:
+        with open(os.path.join(etags_dir, etag), 'w') as f:
+            f.write(digest)
+
+
+@dsl.component(base_image="python:3.11")
+def unzip_data(input_path: Input[Artifact], ratings_output_path: Output[Artifact], movies_output_path: Output[Artifact],
+               md5_url: str = 'https://files.grouplens.org/datasets/movielens/ml-25m.zip.md5', buffer_size_mb: int = 8):
+    """
+    Streams both members to disk concurrently through buffers of buffer_size_mb, instead of holding the
+    decompressed files in memory. zipfile checks the CRC of each member when it reaches its end, and the MD5 of
+    the archive is checked against the GroupLens .md5 file (skipped when md5_url is empty) while extracting.
+    """
+    import hashlib
+    import re
+    import shutil
+    import urllib.request
     import zipfile
-
-    with zipfile.ZipFile(input_path.path, 'r') as z:
-        with open(ratings_output_path.path, 'wb') as f:
-            f.write(z.read('ml-25m/ratings.csv'))
-        with open(movies_output_path.path, 'wb') as f:
-            f.write(z.read('ml-25m/movies.csv'))
-
-
-@dsl.component(base_image="python:3.11", packages_to_install=["scikit-learn", "pandas", "fastparquet"])
-def split_dataset(input_parquet: Input[Artifact], dataset_path: Output[Artifact], random_state: int = 42):
-    from sklearn.model_selection import train_test_split
+    from concurrent.futures import ThreadPoolExecutor
+
+    buffer_size = buffer_size_mb * 1024 * 1024
+
+    def extract(member, output_path):
+        with zipfile.ZipFile(input_path.path, 'r') as z:
+            with z.open(member) as source, open(output_path, 'wb') as f:
+                shutil.copyfileobj(source, f, length=buffer_size)
+
+    def archive_md5():
+        md5 = hashlib.md5()
+        with open(input_path.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(buffer_size), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        extractions = [
+            pool.submit(extract, 'ml-25m/ratings.csv', ratings_output_path.path),
+            pool.submit(extract, 'ml-25m/movies.csv', movies_output_path.path),
+        ]
+        checksum = pool.submit(archive_md5) if md5_url else None
+        for extraction in extractions:
+            extraction.result()
+
+    if checksum is not None:
+        with urllib.request.urlopen(md5_url, timeout=60) as response:
+            md5_text = response.read().decode(errors='replace')
+        # Both the GNU ("<md5>  ml-25m.zip") and BSD ("MD5 (ml-25m.zip) = <md5>") layouts
+        match = re.search(r'\b[0-9a-fA-F]{32}\b', md5_text)
+        if match is None:
+            raise ValueError(f"No MD5 digest found in {md5_url}: {md5_text[:200]!r}")
+        expected = match.group(0).lower()
+        if checksum.result() != expected:
+            raise ValueError(f"MD5 of {input_path.path} is {checksum.result()}, expected {expected}")
+        print(f"MD5 verified: {expected}")
+
+
+@dsl.component(base_image="python:3.11", packages_to_install=["pyarrow", "numpy"])
+def split_dataset(input_parquet: Input[Artifact], dataset_path: Output[Artifact], random_state: int = 42,
+                  split_mode: str = 'random', train_ratio: float = 0.75, validation_ratio: float = 0.15,
+                  leave_last_n: int = 1, compression: str = 'gzip'):
+    """
+    Assigns every rating to train, val or test in one vectorized pass and writes each split once, without the
+    shuffled copies of train_test_split.
+    :param split_mode: str, "random" hashes (userId, movieId, random_state) so each split gets exactly its ratio of
+    rows, "leave_last_n" puts each user's last leave_last_n ratings by timestamp in test and the leave_last_n before
+    them in val (users always keep at least one training rating), "temporal" uses global timestamp cutoffs at
+    train_ratio and train_ratio + validation_ratio
+    :param compression: str, parquet codec of the splits. The file names keep the .parquet.gzip suffix downstream
+    steps read, parquet records the codec itself
+    """
     import os
-    import pandas as pd
-    train_ratio = 0.75
-    validation_ratio = 0.15
-    test_ratio = 0.10
-    ratings_df = pd.read_parquet(input_parquet.path)
-
-    # train is now 75% of the entire data set
-    train, test = train_test_split(
-        ratings_df,                                    
-        test_size=1 - train_ratio,
-        random_state=random_state)
-
-    n_users = ratings_df.userId.max()
-    n_items = ratings_df.movieId.max()
-
-    # test is now 10% of the initial data set
-    # validation is now 15% of the initial data set
-    val, test = train_test_split(
-        test,
-        test_size=test_ratio / (test_ratio + validation_ratio),
-        random_state=random_state)
-    os.mkdir(dataset_path.path)
-    train.to_parquet(os.path.join(dataset_path.path, 'train.parquet.gzip'), compression='gzip')
-    test.to_parquet(os.path.join(dataset_path.path, 'test.parquet.gzip'), compression='gzip')
-    val.to_parquet(os.path.join(dataset_path.path, 'val.parquet.gzip'), compression='gzip')
-
+    import numpy as np
+    import pyarrow as pa
+    from pyarrow import parquet
+
+    TRAIN, VAL, TEST = 0, 1, 2
+    ratings = parquet.read_table(input_parquet.path)
+    n = ratings.num_rows
+    users = ratings.column('userId').to_numpy()
+    n_train = int(np.ceil(train_ratio * n))
+    n_val = int(np.ceil(validation_ratio * n))
+
+    if split_mode == 'random':
+        # splitmix64 of the (userId, movieId) pair, seeded, so the draw does not depend on row order
+        h = (users.astype(np.uint64) << np.uint64(32)) | ratings.column('movieId').to_numpy().astype(np.uint64)
+        h ^= np.uint64((random_state * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF)
+        h ^= h >> np.uint64(30)
+        h *= np.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> np.uint64(27)
+        h *= np.uint64(0x94D049BB133111EB)
+        h ^= h >> np.uint64(31)
+        thresholds = np.partition(h, [n_train - 1, min(n, n_train + n_val) - 1])
+        labels = np.where(h <= thresholds[n_train - 1], TRAIN,
+                          np.where(h <= thresholds[min(n, n_train + n_val) - 1], VAL, TEST)).astype(np.uint8)
+        del h, thresholds
+    elif split_mode == 'leave_last_n':
+        timestamps = ratings.column('timestamp').to_numpy()
+        order = np.lexsort((ratings.column('movieId').to_numpy(), timestamps, users))
+        del timestamps
+        sorted_users = users[order]
+        starts = np.flatnonzero(np.r_[True, sorted_users[1:] != sorted_users[:-1]])
+        del sorted_users
+        last = np.r_[starts[1:], n] - 1
+        # Only the last 2 * leave_last_n rows of each user leave train, so they are addressed per user from the
+        # end of its group instead of ranking every row
+        labels = np.full(n, TRAIN, dtype=np.uint8)
+        for k in range(2 * leave_last_n):
+            # Users always keep their oldest rating in train
+            held_out = last - k > starts
+            labels[order[last[held_out] - k]] = TEST if k < leave_last_n else VAL
+        del order, starts, last
+    elif split_mode == 'temporal':
+        # Ratings sharing the cutoff timestamp stay on the earlier side
+        timestamps = ratings.column('timestamp').to_numpy()
+        cutoffs = np.partition(timestamps, [n_train - 1, min(n, n_train + n_val) - 1])
+        train_cutoff, val_cutoff = cutoffs[n_train - 1], cutoffs[min(n, n_train + n_val) - 1]
+        labels = np.where(timestamps <= train_cutoff, TRAIN, np.where(timestamps <= val_cutoff, VAL, TEST)).astype(np.uint8)
+        print(f"Temporal cutoffs: train <= {train_cutoff}, val <= {val_cutoff}")
+        del cutoffs
+    else:
+        raise ValueError(f"Unknown split_mode {split_mode}, expected random, leave_last_n or temporal")
 
-@dsl.component(base_image="python:3.11", packages_to_install=["scikit-learn", "pandas", "fastparquet"])
-def csv_to_parquet(inputFile: Input[Artifact], output_path: Output[Artifact]):
-    import pandas as pd
-    df = pd.read_csv(inputFile.path, index_col=False)
-    df.to_parquet(output_path.path, compression='gzip') 
+    os.mkdir(dataset_path.path)
+    for name, label in [('train', TRAIN), ('val', VAL), ('test', TEST)]:
+        split = ratings.filter(pa.array(labels == label))
+        parquet.write_table(split, os.path.join(dataset_path.path, f'{name}.parquet.gzip'), compression=compression)
+        print(f"{name}: {split.num_rows} rows ({split.num_rows / n:.2%})")
+
+
+@dsl.component(base_image="python:3.11", packages_to_install=["pyarrow"])
+def csv_to_parquet(inputFile: Input[Artifact], output_path: Output[Artifact], compression: str = 'zstd',
+                   sort_by: str = 'userId', block_size_mb: int = 32):
+    """
+    Streams the csv into parquet one block at a time, so memory does not depend on the file size.
+    MovieLens ids, ratings and timestamps are stored with 32 bit types. Every row group is sorted by
+    sort_by when the file has that column, ratings.csv is already ordered by userId so the row groups are
+    clustered by user as well.
+    """
+    import pyarrow as pa
+    from pyarrow import csv, parquet
+
+    narrow_types = {
+        'userId': pa.int32(),
+        'movieId': pa.int32(),
+        'rating': pa.float32(),
+        'timestamp': pa.uint32(),
+    }
+    reader = csv.open_csv(
+        inputFile.path,
+        read_options=csv.ReadOptions(block_size=block_size_mb * 1024 * 1024),
+        convert_options=csv.ConvertOptions(column_types=narrow_types))
+
+    writer = parquet.ParquetWriter(output_path.path, reader.schema, compression=compression)
+    rows = 0
+    try:
+        for batch in reader:
+            table = pa.Table.from_batches([batch])
+            if sort_by in table.column_names:
+                table = table.sort_by(sort_by)
+            writer.write_table(table)
+            rows += table.num_rows
+    finally:
+        writer.close()
+    print(f"Wrote {rows} rows to {output_path.path} with {compression} compression")
 
 
 @dsl.component(base_image="python:3.11", packages_to_install=["boto3"])
-def put_to_minio(inputFile: Input[Artifact], upload_file_name:str='', bucket: str='datasets'):
+def put_to_minio(inputFile: Input[Artifact], upload_file_name:str='', bucket: str='datasets',
+                 endpoint_url: str='http://minio-service.kubeflow:9000', multipart_chunk_size_mb: int=16,
+                 max_concurrency: int=8, parallel_files: int=4):
+    """
+    Uploads a file, or the files of a directory in parallel, under ml-25m/. The MD5 of each file is kept in the
+    object metadata and objects whose metadata (or single part ETag) already match are skipped.
+    :param multipart_chunk_size_mb: int, part size of multipart uploads, also the threshold to use them
+    :param max_concurrency: int, parts uploaded at once for each file
+    :param parallel_files: int, files of a directory uploaded at once
+    """
     import boto3
+    import hashlib
     import os
-    minio_client = boto3.client(                          
-        's3',                                              
-        endpoint_url='http://minio-service.kubeflow:9000',
+    import time
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+    from concurrent.futures import ThreadPoolExecutor
+    minio_client = boto3.client(
+        's3',
+        endpoint_url=endpoint_url,
         aws_access_key_id='minio',
-        aws_secret_access_key='minio123')
+        aws_secret_access_key='minio123',
+        config=Config(max_pool_connections=max(10, max_concurrency * parallel_files)))
     try:
         minio_client.create_bucket(Bucket=bucket)
     except minio_client.exceptions.BucketAlreadyExists:
@@ -79,19 +330,43 @@ def put_to_minio(inputFile: Input[Artifact], upload_file_name:str='', bucket: st
         print(f"{bucket} already exists, not creating it.")
     except minio_client.exceptions.BucketAlreadyOwnedByYou:
         print(f"{bucket} already exists, not creating it.")
-    
-        
+
+    chunk_size = multipart_chunk_size_mb * 1024 * 1024
+    transfer_config = TransferConfig(multipart_threshold=chunk_size, multipart_chunksize=chunk_size,
+                                     max_concurrency=max_concurrency)
+
+    def upload(local_path, s3_path):
+        md5 = hashlib.md5()
+        with open(local_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                md5.update(chunk)
+        digest = md5.hexdigest()
+        try:
+            head = minio_client.head_object(Bucket=bucket, Key=s3_path)
+            if digest in (head.get('Metadata', {}).get('md5'), head['ETag'].strip('"')):
+                print(f"{s3_path} is unchanged ({digest}), skipping")
+                return
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+        size = os.path.getsize(local_path)
+        start = time.perf_counter()
+        minio_client.upload_file(local_path, bucket, s3_path, ExtraArgs={'Metadata': {'md5': digest}},
+                                 Config=transfer_config)
+        elapsed = time.perf_counter() - start
+        print(f"Uploaded {s3_path}: {size / 2**20:.1f} MB in {elapsed:.1f}s ({size / 2**20 / max(elapsed, 1e-9):.1f} MB/s)")
+
     if os.path.isdir(inputFile.path):
-        for file in os.listdir(inputFile.path):
-            s3_path = os.path.join('ml-25m', file)
-            minio_client.upload_file(os.path.join(inputFile.path, file), bucket, s3_path)
+        files = sorted(os.listdir(inputFile.path))
+        with ThreadPoolExecutor(max_workers=max(1, parallel_files)) as pool:
+            list(pool.map(lambda file: upload(os.path.join(inputFile.path, file), os.path.join('ml-25m', file)), files))
     else:
         if upload_file_name == '':
             _, file = os.path.split(inputFile.path)
         else:
             file = upload_file_name
         s3_path = os.path.join('ml-25m', file)
-        minio_client.upload_file(inputFile.path, bucket, s3_path)
+        upload(inputFile.path, s3_path)
 
 
 @dsl.component(base_image="python:3.11", packages_to_install=["pyarrow", "pandas"]) 
@@ -19,6 +19,11 @@ from data_components import (
 def dataprep_pipeline(
     minio_bucket: str = 'datasets',
     random_init: int = 42,
+    split_mode: str = 'random',
+    split_leave_last_n: int = 1,
+    parquet_compression: str = 'zstd',
+    dataset_url: str = 'https://files.grouplens.org/datasets/movielens/ml-25m.zip',
+    dataset_md5_url: str = 'https://files.grouplens.org/datasets/movielens/ml-25m.zip.md5',
     project_id: str = "tesis-master-ciencia-de-datos",
     dataset_id: str = "feast_staging",
     # New argument to receive the service account JSON key as a string
@@ -26,8 +31,8 @@ def dataprep_pipeline(
     ratings_table_name: str = "ratings",
     movies_table_name: str = "movies",    
 ):
-    download_dataset = download_ml25m_data()
-    unzip_folder = unzip_data(input_path=download_dataset.outputs['output_path_one'])
+    download_dataset = download_ml25m_data(url=dataset_url, md5_url=dataset_md5_url)
+    unzip_folder = unzip_data(input_path=download_dataset.outputs['output_path_one'], md5_url=dataset_md5_url)
 
     # New step to load data into PostgreSQL
     load_to_bigquery_task = load_to_bigquery(
@@ -44,9 +49,11 @@ def dataprep_pipeline(
     # Subsequent tasks will continue as before, using the unzipped artifacts
     # The `ratings_parquet_op` and `movies_parquet_op` tasks will now run in parallel
     # with the `load_to_bigquery_task` as they share the same input
-    ratings_parquet_op = csv_to_parquet(inputFile=unzip_folder.outputs['ratings_output_path'])
-    movies_parquet_op = csv_to_parquet(inputFile=unzip_folder.outputs['movies_output_path'])
-    split_op = split_dataset(input_parquet=ratings_parquet_op.output, random_state=random_init)
+    ratings_parquet_op = csv_to_parquet(inputFile=unzip_folder.outputs['ratings_output_path'], compression=parquet_compression)
+    movies_parquet_op = csv_to_parquet(inputFile=unzip_folder.outputs['movies_output_path'], compression=parquet_compression)
+    split_op = split_dataset(input_parquet=ratings_parquet_op.output, random_state=random_init,
+                             split_mode=split_mode, leave_last_n=split_leave_last_n,
+                             compression=parquet_compression)
     u1 = put_to_minio(inputFile=movies_parquet_op.output, upload_file_name='movies.parquet.gzip', bucket=minio_bucket)
     u2 = put_to_minio(inputFile=split_op.output, bucket=minio_bucket)
     qa_op = qa_data(bucket=minio_bucket).after(u2)
@@ -0,0 +1,129 @@
+import argparse
+import time
+
+import numpy as np
+
+
+class IVFIndex:
+    """
+    Inverted file index over the item embedding table for maximum inner product candidate retrieval.
+
+    Items are clustered with k-means at load time. A query scores the centroids, probes the best
+    lists and returns the items with the highest exact inner product among the probed lists.
+    """
+
+    def __init__(self, item_vectors, n_lists=256, n_iter=10, seed=42, chunk_size=16384):
+        self.vectors = np.ascontiguousarray(item_vectors, dtype=np.float32)
+        self.chunk_size = chunk_size
+        n_lists = max(1, min(n_lists, self.vectors.shape[0]))
+
+        rng = np.random.default_rng(seed)
+        centroids = self.vectors[rng.choice(self.vectors.shape[0], n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignment = self._assign(centroids)
+            order, offsets = self._lists(assignment, n_lists)
+            counts = np.diff(offsets)
+            non_empty = counts > 0
+            sums = np.add.reduceat(self.vectors[order], offsets[:-1][non_empty], axis=0)
+            centroids[non_empty] = sums / counts[non_empty, None]
+
+        self.centroids = centroids
+        self.order, self.offsets = self._lists(self._assign(centroids), n_lists)
+
+    def _assign(self, centroids):
+        assignment = np.empty(self.vectors.shape[0], dtype=np.int64)
+        centroid_norms = (centroids * centroids).sum(axis=1)
+        for start in range(0, self.vectors.shape[0], self.chunk_size):
+            chunk = self.vectors[start : start + self.chunk_size]
+            distances = centroid_norms - 2.0 * (chunk @ centroids.T)
+            assignment[start : start + chunk.shape[0]] = distances.argmin(axis=1)
+        return assignment
+
+    @staticmethod
+    def _lists(assignment, n_lists):
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=offsets[1:])
+        return order, offsets
+
+    def search(self, query, n_candidates, n_probe=8):
+        """
+        Retrieve candidate items for a user embedding.
+        :param query: array (n_factors,), user embedding
+        :param n_candidates: int, number of candidates to return
+        :param n_probe: int, minimum number of lists to probe. More are probed until n_candidates items are available.
+        :return: int64 array of item Ids (1-based, as used by the serving model), unsorted
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        list_order = np.argsort(-(self.centroids @ query))
+        list_sizes = np.diff(self.offsets)[list_order]
+        enough = np.searchsorted(np.cumsum(list_sizes), n_candidates)
+        probed = list_order[: max(n_probe, enough + 1)]
+
+        candidates = np.concatenate([self.order[self.offsets[lst] : self.offsets[lst + 1]] for lst in probed])
+        if candidates.shape[0] > n_candidates:
+            scores = self.vectors[candidates] @ query
+            candidates = candidates[np.argpartition(-scores, n_candidates - 1)[:n_candidates]]
+        return candidates + 1
+
+
+def recall_report(scorer, index, user_ids, top_k=10, candidate_sizes=(100, 500, 1000, 5000), n_probe=8):
+    """
+    Compare two-stage retrieval against exact full-catalogue scoring.
+    :param scorer: ItemTowerScorer built from the model being served
+    :param index: IVFIndex built over the same item table
+    :param user_ids: list, user Ids to evaluate
+    :param top_k: int, size of the recommendation list
+    :param candidate_sizes: list, values of M to evaluate
+    :return: list of dicts with the mean recall@k and mean latency for every M, plus the exact baseline
+    """
+    import torch
+
+    exact = {}
+    start = time.perf_counter()
+    for user_id in user_ids:
+        predictions = scorer.score(torch.tensor([user_id]))[0]
+        exact[user_id] = set(scorer.item_ids[torch.topk(predictions, top_k).indices].tolist())
+    report = [{"candidates": "exact", "recall": 1.0, "latency_ms": 1000 * (time.perf_counter() - start) / len(user_ids)}]
+
+    for n_candidates in candidate_sizes:
+        recall = 0.0
+        start = time.perf_counter()
+        for user_id in user_ids:
+            query = scorer.user_vectors(torch.tensor([user_id]))[0].cpu().numpy()
+            candidates = torch.from_numpy(index.search(query, n_candidates, n_probe))
+            predictions = scorer.score(torch.tensor([user_id]), items=candidates)[0]
+            top = candidates[torch.topk(predictions, min(top_k, candidates.shape[0])).indices]
+            recall += len(exact[user_id].intersection(top.tolist())) / top_k
+        report.append({
+            "candidates": n_candidates,
+            "recall": recall / len(user_ids),
+            "latency_ms": 1000 * (time.perf_counter() - start) / len(user_ids),
+        })
+    return report
+
+
+if __name__ == "__main__":
+    import mlflow
+    from scoring import ItemTowerScorer
+
+    parser = argparse.ArgumentParser(description="Recall@k of ANN candidate retrieval against exact scoring")
+    parser.add_argument("--model-uri", required=True, help="MLflow model uri, e.g. runs:/<run_id>/model")
+    parser.add_argument("--tracking-uri", default="http://192.168.1.90:8080")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--users", type=int, default=200, help="number of random users to evaluate")
+    parser.add_argument("--candidates", type=int, nargs="+", default=[100, 500, 1000, 5000])
+    parser.add_argument("--lists", type=int, default=256)
+    parser.add_argument("--probe", type=int, default=8)
+    args = parser.parse_args()
+
+    mlflow.set_tracking_uri(uri=args.tracking_uri)
+    model = mlflow.pytorch.load_model(args.model_uri)
+    model.eval()
+    scorer = ItemTowerScorer.from_model(model)
+    index = IVFIndex(scorer.item_vectors().numpy(), n_lists=args.lists)
+
+    users = np.random.default_rng(0).integers(1, scorer.user_table.shape[0], size=args.users).tolist()
+    print(f"{'M':>8} {'recall@' + str(args.top_k):>10} {'latency ms':>11}")
+    for row in recall_report(scorer, index, users, args.top_k, args.candidates, args.probe):
+        print(f"{row['candidates']:>8} {row['recall']:>10.4f} {row['latency_ms']:>11.2f}")
@@ -0,0 +1,246 @@
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def load_requests(path):
+    """
+    Read recorded requests, one JSON object per line with user_id and optional top_k and ranked_movies.
+    """
+    requests = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            payload = json.loads(line)
+            requests.append({
+                "user_id": int(payload["user_id"]),
+                "top_k": int(payload.get("top_k", 10)),
+                "ranked_movies": payload.get("ranked_movies"),
+            })
+    return requests
+
+
+def synthetic_requests(n_requests, n_users, n_items, top_k_choices=(10, 20, 50), ranked_sizes=(0, 10, 100, 1000),
+                       user_skew=1.1, seed=42):
+    """
+    Generate a request mix with Zipf distributed users, so popular users repeat as they do in production.
+    :param ranked_sizes: list, sizes of ranked_movies drawn uniformly for each request, 0 sends none
+    """
+    rng = np.random.default_rng(seed)
+    if user_skew > 1.0:
+        users = (rng.zipf(user_skew, size=n_requests) - 1) % n_users + 1
+    else:
+        users = rng.integers(1, n_users + 1, size=n_requests)
+    requests = []
+    for user_id in users:
+        ranked_size = int(rng.choice(ranked_sizes))
+        ranked_movies = None
+        if ranked_size > 0:
+            ranked_movies = rng.choice(np.arange(1, n_items + 1), size=min(ranked_size, n_items), replace=False).tolist()
+        requests.append({
+            "user_id": int(user_id),
+            "top_k": int(rng.choice(top_k_choices)),
+            "ranked_movies": ranked_movies,
+        })
+    return requests
+
+
+def build_random_model(n_users, n_items, n_factors=20, hidden_dim=256, seed=42):
+    """
+    MatrixFactorization with the layout of the training component and random weights.
+    """
+    import torch
+
+    torch.manual_seed(seed)
+
+    class MatrixFactorization(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.n_items = n_items
+            self.user_factors = torch.nn.Embedding(n_users + 1, n_factors, sparse=False)
+            self.item_factors = torch.nn.Embedding(n_items + 1, n_factors, sparse=False)
+            self.linear = torch.nn.Linear(in_features=n_factors, out_features=hidden_dim)
+            self.linear2 = torch.nn.Linear(in_features=hidden_dim, out_features=1)
+            self.dropout = torch.nn.Dropout(p=0.2)
+            self.relu = torch.nn.ReLU()
+
+    return MatrixFactorization().eval()
+
+
+def in_process_client(n_users, n_items, n_factors, hidden_dim, cache_size=0):
+    """
+    RecommenderRunable.predict on a random-weight model, without MLflow or an HTTP server.
+    """
+    from cache import RecommendationCache
+    from scoring import ItemTowerScorer
+    from service import RecommenderRunable, ServedModel
+
+    model = build_random_model(n_users, n_items, n_factors, hidden_dim)
+    service = RecommenderRunable.inner.__new__(RecommenderRunable.inner)
+    service.device = "cpu"
+    service.history = None
+    service.cache = RecommendationCache(max_size=cache_size) if cache_size > 0 else None
+    service.model = ServedModel("benchmark", "benchmark", ItemTowerScorer.from_model(model))
+
+    def call(request):
+        ranked_movies = request["ranked_movies"]
+        if ranked_movies is not None:
+            ranked_movies = np.asarray(ranked_movies, dtype=np.int64)
+        service.predict(user_id=request["user_id"], top_k=request["top_k"], ranked_movies=ranked_movies)
+
+    return call
+
+
+def http_client(url, timeout=10):
+    import requests
+
+    sessions = threading.local()
+
+    def call(request):
+        session = getattr(sessions, "session", None)
+        if session is None:
+            session = sessions.session = requests.Session()
+        payload = {"user_id": request["user_id"], "top_k": request["top_k"]}
+        if request["ranked_movies"] is not None:
+            payload["ranked_movies"] = request["ranked_movies"]
+        response = session.post(f"{url.rstrip('/')}/predict", json=payload, timeout=timeout)
+        response.raise_for_status()
+
+    return call
+
+
+def run_closed_loop(call, requests, concurrency):
+    """
+    Each of the concurrency workers sends its next request as soon as the previous one returns.
+    """
+    latencies = np.zeros(len(requests))
+    errors = []
+
+    def worker(worker_id):
+        for i in range(worker_id, len(requests), concurrency):
+            start = time.perf_counter()
+            try:
+                call(requests[i])
+            except Exception as e:
+                errors.append(repr(e))
+            latencies[i] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return latencies, time.perf_counter() - start, errors
+
+
+def run_open_loop(call, requests, qps, max_workers=256):
+    """
+    Requests are sent at a fixed rate whatever the latency. Latency is measured from the scheduled send time,
+    so queueing behind a saturated service shows up in the percentiles.
+    """
+    latencies = np.zeros(len(requests))
+    errors = []
+
+    def send(i, scheduled):
+        try:
+            call(requests[i])
+        except Exception as e:
+            errors.append(repr(e))
+        latencies[i] = time.perf_counter() - scheduled
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for i in range(len(requests)):
+            scheduled = start + i / qps
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, i, scheduled)
+    return latencies, time.perf_counter() - start, errors
+
+
+def summarize(latencies, elapsed, errors):
+    latencies_ms = 1000 * latencies
+    return {
+        "requests": int(latencies.shape[0]),
+        "errors": len(errors),
+        "elapsed_s": elapsed,
+        "throughput_rps": latencies.shape[0] / elapsed,
+        "mean_ms": float(latencies_ms.mean()),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "max_ms": float(latencies_ms.max()),
+    }
+
+
+def compare(result, baseline):
+    print(f"{'metric':>15} {'baseline':>10} {'current':>10} {'change':>8}")
+    for metric in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms"):
+        before, after = baseline["summary"][metric], result["summary"][metric]
+        change = 100 * (after - before) / before if before else float("nan")
+        print(f"{metric:>15} {before:>10.2f} {after:>10.2f} {change:>7.1f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recommendation requests and report latency percentiles")
+    parser.add_argument("--url", help="base url of a running BentoML service, e.g. http://localhost:3000")
+    parser.add_argument("--in-process", action="store_true",
+                        help="call RecommenderRunable.predict directly on a random-weight model")
+    parser.add_argument("--requests", help="recorded requests, one JSON object per line")
+    parser.add_argument("--n-requests", type=int, default=2000, help="number of synthetic requests")
+    parser.add_argument("--n-users", type=int, default=162541)
+    parser.add_argument("--n-items", type=int, default=209171)
+    parser.add_argument("--n-factors", type=int, default=20)
+    parser.add_argument("--hidden-dim", type=int, default=256)
+    parser.add_argument("--top-k", type=int, nargs="+", default=[10, 20, 50])
+    parser.add_argument("--ranked-sizes", type=int, nargs="+", default=[0, 10, 100, 1000])
+    parser.add_argument("--user-skew", type=float, default=1.1, help="Zipf exponent of the user distribution, <= 1 is uniform")
+    parser.add_argument("--cache-size", type=int, default=0, help="result cache size for --in-process")
+    parser.add_argument("--concurrency", type=int, default=4, help="closed loop workers")
+    parser.add_argument("--qps", type=float, help="open loop request rate, overrides --concurrency")
+    parser.add_argument("--warmup", type=int, default=20, help="requests sent before measuring")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="results JSON of a previous run to compare against")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if args.requests:
+        requests = load_requests(args.requests)
+    else:
+        requests = synthetic_requests(args.n_requests, args.n_users, args.n_items, args.top_k, args.ranked_sizes,
+                                      args.user_skew, args.seed)
+
+    if args.in_process:
+        call = in_process_client(args.n_users, args.n_items, args.n_factors, args.hidden_dim, args.cache_size)
+    elif args.url:
+        call = http_client(args.url)
+    else:
+        parser.error("either --url or --in-process is required")
+
+    for request in requests[: args.warmup]:
+        call(request)
+
+    if args.qps:
+        latencies, elapsed, errors = run_open_loop(call, requests, args.qps)
+    else:
+        latencies, elapsed, errors = run_closed_loop(call, requests, args.concurrency)
+
+    summary = summarize(latencies, elapsed, errors)
+    for metric, value in summary.items():
+        print(f"{metric:>15}: {value:.2f}" if isinstance(value, float) else f"{metric:>15}: {value}")
+    if errors:
+        print(f"first error: {errors[0]}")
+
+    config = {k: v for k, v in vars(args).items() if k not in ("output", "baseline")}
+    result = {"config": config, "summary": summary, "timestamp": time.time()}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(result, json.load(f))
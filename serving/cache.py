@@ -0,0 +1,61 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import cache_hit_counter, cache_miss_counter, cache_eviction_counter
+
+
+class RecommendationCache:
+    """
+    Thread safe LRU cache with a time to live for top k recommendation lists.
+    Entries are keyed on (model run_id, user_id, top_k, hash of the ranked movies).
+    """
+
+    def __init__(self, max_size=100000, ttl_seconds=300.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(run_id, user_id, top_k, ranked_movies=None):
+        ranked_hash = None
+        if ranked_movies is not None:
+            ranked = np.unique(np.asarray(ranked_movies, dtype=np.int64))
+            ranked_hash = hashlib.blake2b(ranked.tobytes(), digest_size=16).hexdigest()
+        return run_id, int(user_id), int(top_k), ranked_hash
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                cache_eviction_counter.inc()
+                entry = None
+            if entry is None:
+                cache_miss_counter.inc()
+                return None
+            self._entries.move_to_end(key)
+        cache_hit_counter.inc()
+        return entry[1]
+
+    def put(self, key, value):
+        value.setflags(write=False)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                cache_eviction_counter.inc()
+
+    def clear(self):
+        with self._lock:
+            evicted = len(self._entries)
+            self._entries.clear()
+        cache_eviction_counter.inc(evicted)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,38 @@
+import os
+
+# Adaptive batching for predict_batch. BentoML groups concurrent requests until either limit is hit.
+MAX_BATCH_SIZE = int(os.environ.get("RECOMMENDER_MAX_BATCH_SIZE", "64"))
+MAX_LATENCY_MS = int(os.environ.get("RECOMMENDER_MAX_LATENCY_MS", "20"))
+BATCH_TOP_K = int(os.environ.get("RECOMMENDER_BATCH_TOP_K", "10"))
+
+# Candidate retrieval for predict: "exact" scores the whole catalogue, "ann" re-ranks IVF candidates only.
+RETRIEVAL_MODE = os.environ.get("RECOMMENDER_RETRIEVAL_MODE", "exact")
+ANN_CANDIDATES = int(os.environ.get("RECOMMENDER_ANN_CANDIDATES", "1000"))
+ANN_LISTS = int(os.environ.get("RECOMMENDER_ANN_LISTS", "256"))
+ANN_PROBES = int(os.environ.get("RECOMMENDER_ANN_PROBES", "8"))
+
+# Top k result cache in front of predict. A size of 0 disables it.
+CACHE_SIZE = int(os.environ.get("RECOMMENDER_CACHE_SIZE", "100000"))
+CACHE_TTL_SECONDS = float(os.environ.get("RECOMMENDER_CACHE_TTL_SECONDS", "300"))
+# How often the MLflow prod alias is checked for a new model version.
+ALIAS_POLL_SECONDS = float(os.environ.get("RECOMMENDER_ALIAS_POLL_SECONDS", "60"))
+# Load the new prod model in the background and swap it in when the alias moves, instead of a redeploy.
+HOT_SWAP = os.environ.get("RECOMMENDER_HOT_SWAP", "1") == "1"
+
+# Serve from the top k table precomputed by the training pipeline when the prod run has one.
+USE_PRECOMPUTED = os.environ.get("RECOMMENDER_USE_PRECOMPUTED", "1") == "1"
+
+# Directory of the ranked movies store built by history.py, used by predict(exclude_history=True).
+HISTORY_PATH = os.environ.get("RECOMMENDER_HISTORY_PATH", "")
+
+# "eager" serves the MLflow pytorch model, "torchscript" the frozen graph logged by export_inference_model
+# and "quantized" the fp16 / int8 embedding tables logged by quantize_model.
+MODEL_FORMAT = os.environ.get("RECOMMENDER_MODEL_FORMAT", "eager")
+# Torch intra-op threads, 0 keeps the torch default.
+INTRA_OP_THREADS = int(os.environ.get("RECOMMENDER_INTRA_OP_THREADS", "0"))
+WARMUP_ITERATIONS = int(os.environ.get("RECOMMENDER_WARMUP_ITERATIONS", "3"))
+
+# Local model cache shared by restarts and replicas on the same node, keyed by MLflow run_id.
+MODEL_CACHE_DIR = os.environ.get(
+    "RECOMMENDER_MODEL_CACHE_DIR", os.path.expanduser("~/.cache/recommender")
+)
@@ -0,0 +1,49 @@
+import argparse
+import os
+
+import numpy as np
+
+
+class UserHistoryStore:
+    """
+    Read only store of the movies each user already ranked, kept as a memory-mapped CSR layout:
+    the movies of user u are items[indptr[u]:indptr[u + 1]].
+    """
+
+    def __init__(self, path):
+        self.indptr = np.load(os.path.join(path, "history_indptr.npy"), mmap_mode="r")
+        self.items = np.load(os.path.join(path, "history_items.npy"), mmap_mode="r")
+
+    def get(self, user_id):
+        if not 0 <= user_id < self.indptr.shape[0] - 1:
+            return np.empty(0, dtype=self.items.dtype)
+        return self.items[self.indptr[user_id] : self.indptr[user_id + 1]]
+
+
+def build_history(ratings_path, output_path):
+    """
+    Build the history store from a ratings parquet file with userId and movieId columns.
+    :param ratings_path: str, path to the ratings parquet
+    :param output_path: str, directory the store is written to
+    """
+    from pyarrow import parquet
+
+    ratings = parquet.read_table(ratings_path, columns=["userId", "movieId"])
+    users = ratings.column("userId").to_numpy()
+    movies = ratings.column("movieId").to_numpy()
+
+    order = np.argsort(users, kind="stable")
+    indptr = np.zeros(int(users.max()) + 2, dtype=np.int64)
+    np.cumsum(np.bincount(users, minlength=indptr.shape[0] - 1), out=indptr[1:])
+
+    os.makedirs(output_path, exist_ok=True)
+    np.save(os.path.join(output_path, "history_indptr.npy"), indptr)
+    np.save(os.path.join(output_path, "history_items.npy"), movies[order].astype(np.int32))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the ranked movies store used by predict(exclude_history=True)")
+    parser.add_argument("--ratings", required=True, help="ratings parquet file")
+    parser.add_argument("--output", required=True, help="output directory")
+    args = parser.parse_args()
+    build_history(args.ratings, args.output)
@@ -1,10 +1,70 @@
-from bentoml.metrics import Counter
+import time
+
+from bentoml.metrics import Counter, Histogram
 
 ranked_movie_present_counter = Counter(
     name="ranked_movie_present_counter",
     documentation="The number of times ranked movies is present in the request",
 )
 ranked_movie_absent_counter = Counter(
-    name="ranked_movie_present_counter",
+    name="ranked_movie_absent_counter",
     documentation="The number of times ranked movies is absent in the request",
 )
+cache_hit_counter = Counter(
+    name="recommendation_cache_hit_counter",
+    documentation="The number of predictions served from the recommendation cache",
+)
+cache_miss_counter = Counter(
+    name="recommendation_cache_miss_counter",
+    documentation="The number of predictions not found in the recommendation cache",
+)
+cache_eviction_counter = Counter(
+    name="recommendation_cache_eviction_counter",
+    documentation="The number of entries evicted from the recommendation cache by size, ttl or model change",
+)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+request_latency_histogram = Histogram(
+    name="recommendation_request_duration_seconds",
+    documentation="End to end latency of a recommendation request, by endpoint and by where the answer came from",
+    labelnames=["endpoint", "source", "model_version"],
+    buckets=LATENCY_BUCKETS,
+)
+stage_latency_histogram = Histogram(
+    name="recommendation_stage_duration_seconds",
+    documentation="Latency of each stage of online scoring",
+    labelnames=["stage", "model_version"],
+    buckets=LATENCY_BUCKETS,
+)
+candidate_count_histogram = Histogram(
+    name="recommendation_candidate_count",
+    documentation="The number of items scored for a request",
+    labelnames=["model_version"],
+    buckets=(10, 100, 1000, 5000, 10000, 50000, 100000, 250000, 500000),
+)
+ranked_movies_length_histogram = Histogram(
+    name="recommendation_ranked_movies_length",
+    documentation="The number of ranked movies excluded from a request",
+    buckets=(0, 1, 10, 50, 100, 500, 1000, 2500, 5000, 10000),
+)
+batch_size_histogram = Histogram(
+    name="recommendation_batch_size",
+    documentation="The number of users scored together by predict_batch",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+
+
+class StageTimer:
+    """
+    Records the time elapsed since the previous stage into stage_latency_histogram.
+    """
+
+    def __init__(self, model_version):
+        self.model_version = model_version
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        stage_latency_histogram.labels(stage=stage, model_version=self.model_version).observe(now - self.last)
+        self.last = now
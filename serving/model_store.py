@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import tempfile
+
+import mlflow
+import numpy as np
+import torch
+
+from scoring import model_weights
+
+
+class ModelStore:
+    """
+    Local cache of served models keyed by MLflow run_id.
+
+    The first replica that loads a run writes its weights as one .npy file per tensor. Restarts and
+    other replicas sharing the directory memory-map those files instead of downloading and unpickling
+    the model again, so the pages are shared between processes and only read when touched.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _entry(self, run_id, name):
+        return os.path.join(self.root, run_id, name)
+
+    def _publish(self, tmp_path, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another replica published the same run first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def weights(self, run_id, model_format="eager"):
+        """
+        Scorer weights of a run, memory-mapped from the local cache.
+        :param model_format: "quantized" for the quantized/weights.pt artifact, anything else for the float model
+        """
+        name = "quantized" if model_format == "quantized" else "float"
+        path = self._entry(run_id, name)
+        if not os.path.exists(os.path.join(path, "manifest.json")):
+            if name == "quantized":
+                weights_path = mlflow.artifacts.download_artifacts(f"runs:/{run_id}/quantized/weights.pt")
+                weights = torch.load(weights_path, map_location="cpu")
+            else:
+                model = mlflow.pytorch.load_model(f"runs:/{run_id}/model", map_location="cpu")
+                weights = model_weights(model)
+            self._write(weights, path)
+        return self._read(path)
+
+    def artifact(self, run_id, artifact_path):
+        """
+        Local path of a run artifact, downloaded once.
+        """
+        path = self._entry(run_id, os.path.join("artifacts", artifact_path))
+        if not os.path.exists(path):
+            tmp_path = tempfile.mkdtemp(dir=self.root)
+            downloaded = mlflow.artifacts.download_artifacts(f"runs:/{run_id}/{artifact_path}", dst_path=tmp_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.rename(downloaded, path)
+            except OSError:
+                pass
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return path
+
+    def _write(self, weights, path):
+        tmp_path = tempfile.mkdtemp(dir=self.root)
+        manifest = {"n_items": int(weights["n_items"]), "tensors": []}
+        for name, tensor in weights.items():
+            if not isinstance(tensor, torch.Tensor):
+                continue
+            np.save(os.path.join(tmp_path, f"{name}.npy"), tensor.detach().cpu().contiguous().numpy())
+            manifest["tensors"].append(name)
+        with open(os.path.join(tmp_path, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        self._publish(tmp_path, path)
+
+    @staticmethod
+    def _read(path):
+        with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+        weights = {"n_items": manifest["n_items"]}
+        for name in manifest["tensors"]:
+            # Copy on write keeps the arrays writable for torch without copying the file
+            weights[name] = torch.from_numpy(np.load(os.path.join(path, f"{name}.npy"), mmap_mode="c"))
+        return weights
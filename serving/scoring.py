@@ -0,0 +1,157 @@
+import threading
+
+import torch
+
+
+def model_weights(model):
+    """
+    Tensors the serving scorer needs from a MatrixFactorization model.
+    :return: dict in the layout accepted by ItemTowerScorer
+    """
+    weights = {"n_items": model.n_items}
+    weights["user_factors"] = model.user_factors.weight.detach()
+    weights["item_factors"] = model.item_factors.weight.detach()
+    weights.update({k: v.detach() for k, v in model.state_dict().items() if k.startswith("linear")})
+    return weights
+
+
+class ItemTowerScorer:
+    """
+    Scores the full catalogue for a batch of users with the MatrixFactorization head.
+
+    The item side of the model (embedding table, item id buffer, layer weights) is laid out
+    once at load time. Per request only the user embeddings are folded into the first linear
+    layer, so the forward pass never gathers or repeats anything over the catalogue:
+
+        linear(u * i) == i @ (W1 * u).T + b1
+
+    Hidden activations are computed block by block into per-thread scratch buffers that are
+    reused across requests, and across scorers when the scratch of the previous one is passed in.
+    Embedding tables may be stored as fp16 or per-row int8, in which case
+    each block of items is dequantized into scratch just before its GEMM. When a compiled
+    TorchScript scorer exported by the training pipeline is given, scoring is delegated to it.
+    """
+
+    def __init__(self, weights, device="cpu", block_elements=1 << 22, compiled=None, scratch=None):
+        """
+        :param weights: dict with n_items, user_factors, item_factors, linear.weight, linear.bias,
+            linear2.weight, linear2.bias and, for int8 tables, user_factors_scale and item_factors_scale
+        :param scratch: optional threading.local of another scorer, whose per-thread buffers are reused
+            when their shapes still fit
+        """
+        self.device = device
+        self.compiled = compiled
+        self.n_items = int(weights["n_items"])
+        self.block_elements = block_elements
+
+        with torch.no_grad():
+            self.item_ids = torch.arange(1, self.n_items + 1, dtype=torch.long, device=device)
+            self.item_table = weights["item_factors"][1 : self.n_items + 1].detach().to(device).contiguous()
+            self.user_table = weights["user_factors"].detach().to(device)
+            self.item_scale = self._optional(weights, "item_factors_scale")
+            if self.item_scale is not None:
+                self.item_scale = self.item_scale[1 : self.n_items + 1].contiguous()
+            self.user_scale = self._optional(weights, "user_factors_scale")
+            self.w1 = weights["linear.weight"].detach().to(device).float().contiguous()
+            self.b1 = weights["linear.bias"].detach().to(device).float().contiguous()
+            self.w2 = weights["linear2.weight"].detach().to(device).float().reshape(-1).contiguous()
+            self.b2 = float(weights["linear2.bias"].detach()[0])
+
+        self.n_factors = self.w1.shape[1]
+        self.hidden_dim = self.w1.shape[0]
+        self.quantized = self.item_table.dtype != torch.float32
+        self._scratch = scratch if scratch is not None else threading.local()
+
+    @classmethod
+    def from_model(cls, model, device="cpu", block_elements=1 << 22, compiled=None, scratch=None):
+        return cls(model_weights(model), device=device, block_elements=block_elements, compiled=compiled,
+                   scratch=scratch)
+
+    def page_in(self):
+        """
+        Read every page of the embedding tables, which may be memory-mapped from the model cache.
+        """
+        for table in (self.user_table, self.item_table):
+            table.sum()
+
+    def _optional(self, weights, name):
+        if weights.get(name) is None:
+            return None
+        return weights[name].detach().to(self.device).float()
+
+    @staticmethod
+    def _dequantize(rows, scale, out=None):
+        if scale is not None:
+            return torch.mul(rows, scale.unsqueeze(1), out=out)
+        if rows.dtype != torch.float32:
+            return rows.float() if out is None else out.copy_(rows)
+        return rows
+
+    def user_vectors(self, user_ids):
+        user_ids = user_ids.to(self.device)
+        scale = None if self.user_scale is None else self.user_scale[user_ids]
+        return self._dequantize(self.user_table[user_ids], scale)
+
+    def item_vectors(self):
+        return self._dequantize(self.item_table, self.item_scale)
+
+    def _buffers(self, n_users):
+        scratch = self._scratch
+        hidden = getattr(scratch, "hidden", None)
+        if hidden is None or hidden.shape[0] < n_users * self.hidden_dim:
+            size = max(self.block_elements, n_users * self.hidden_dim)
+            hidden = torch.empty(size, dtype=torch.float32, device=self.device)
+            scratch.hidden = hidden
+            scratch.items = None
+        rows = hidden.shape[0] // self.hidden_dim
+        items = getattr(scratch, "items", None)
+        if self.quantized and (items is None or items.shape != (rows, self.n_factors)):
+            scratch.items = torch.empty((rows, self.n_factors), dtype=torch.float32, device=self.device)
+        scores = getattr(scratch, "scores", None)
+        if scores is None or scores.shape[0] < n_users or scores.shape[1] != self.n_items:
+            scores = torch.empty((n_users, self.n_items), dtype=torch.float32, device=self.device)
+            scratch.scores = scores
+        return hidden, getattr(scratch, "items", None), scores[:n_users]
+
+    @torch.inference_mode()
+    def score(self, user_ids, items=None):
+        """
+        Predict ratings of every item (or of the given item ids) for each user.
+        :param user_ids: LongTensor (n_users,), user Ids
+        :param items: optional LongTensor (n_candidates,) of item Ids to score instead of the full catalogue
+        :return: tensor (n_users, n_items). Full catalogue scores are a view on a per-thread buffer,
+            only valid until the next call to score from the same thread.
+        """
+        user_ids = user_ids.to(self.device)
+        if self.compiled is not None:
+            return self.compiled(user_ids, None if items is None else items.to(self.device))
+
+        n_users = user_ids.shape[0]
+        # (n_factors, n_users * hidden_dim): one GEMM against the item table scores every user at once
+        folded_w1 = self.w1.unsqueeze(0) * self.user_vectors(user_ids).unsqueeze(1)
+        folded_w1 = folded_w1.permute(2, 0, 1).reshape(-1, n_users * self.hidden_dim)
+        folded_b1 = self.b1.repeat(n_users)
+
+        hidden, item_buffer, scores = self._buffers(n_users)
+        item_table, item_scale = self.item_table, self.item_scale
+        if items is not None:
+            items = items.to(self.device) - 1
+            item_table = item_table[items]
+            if item_scale is not None:
+                item_scale = item_scale[items]
+            scores = torch.empty((n_users, item_table.shape[0]), dtype=torch.float32, device=self.device)
+
+        n_rows = item_table.shape[0]
+        block = max(1, hidden.shape[0] // (n_users * self.hidden_dim))
+        for start in range(0, n_rows, block):
+            end = min(start + block, n_rows)
+            rows = item_table[start:end]
+            if self.quantized:
+                scale = None if item_scale is None else item_scale[start:end]
+                rows = self._dequantize(rows, scale, out=item_buffer[: end - start])
+            h = hidden[: (end - start) * n_users * self.hidden_dim].view(end - start, -1)
+            torch.addmm(folded_b1, rows, folded_w1, out=h)
+            h.relu_()
+            scores[:, start:end] = torch.matmul(h.view(end - start, n_users, self.hidden_dim), self.w2).t()
+        scores.add_(self.b2)
+        return scores
@@ -1,9 +1,67 @@
+import contextlib
+import threading
+import time
+
 import bentoml
+from bentoml.exceptions import InvalidArgument
 import mlflow
 import torch
 import numpy as np
 from mlflow import MlflowClient
-from metrics import ranked_movie_present_counter, ranked_movie_absent_counter
+from metrics import (
+    ranked_movie_present_counter,
+    ranked_movie_absent_counter,
+    request_latency_histogram,
+    candidate_count_histogram,
+    ranked_movies_length_histogram,
+    batch_size_histogram,
+    StageTimer,
+)
+from scoring import ItemTowerScorer
+from ann import IVFIndex
+from cache import RecommendationCache
+from history import UserHistoryStore
+from model_store import ModelStore
+from config import (
+    MAX_BATCH_SIZE,
+    MAX_LATENCY_MS,
+    BATCH_TOP_K,
+    RETRIEVAL_MODE,
+    ANN_CANDIDATES,
+    ANN_LISTS,
+    ANN_PROBES,
+    CACHE_SIZE,
+    CACHE_TTL_SECONDS,
+    ALIAS_POLL_SECONDS,
+    USE_PRECOMPUTED,
+    HISTORY_PATH,
+    MODEL_FORMAT,
+    INTRA_OP_THREADS,
+    WARMUP_ITERATIONS,
+    MODEL_CACHE_DIR,
+    HOT_SWAP,
+)
+
+
+@contextlib.contextmanager
+def timed(phase, timings):
+    start = time.perf_counter()
+    yield
+    timings[phase] = time.perf_counter() - start
+
+
+class ServedModel:
+    """
+    Everything predict needs from one MLflow run. The service swaps the whole object when the
+    prod alias moves, so a request that picked it up keeps a consistent model until it returns.
+    """
+
+    def __init__(self, run_id, version, scorer, index=None, precomputed=None):
+        self.run_id = run_id
+        self.version = str(version)
+        self.scorer = scorer
+        self.index = index
+        self.precomputed = precomputed
 
 
 @bentoml.service(
@@ -12,46 +70,264 @@ from metrics import ranked_movie_present_counter, ranked_movie_absent_counter
 )
 class RecommenderRunable:
     def __init__(self, registered_model_name="recommender_production", device="cpu"):
-        mlflow.set_tracking_uri(uri="http://192.168.1.90:8080")
-        client = MlflowClient()
-        current_prod = client.get_model_version_by_alias(registered_model_name, "prod")
-        model_uri = f"runs:/{current_prod.run_id}/model"
-        print(model_uri)
-        bentoml.mlflow.import_model("recommender", model_uri)
-        bento_model = bentoml.mlflow.get("recommender:latest")
-        mlflow_model_path = bento_model.path_of(bentoml.mlflow.MLFLOW_MODEL_FOLDER)
-
-        self.model = mlflow.pytorch.load_model(mlflow_model_path)
+        timings = {}
+        with timed("resolve_alias", timings):
+            mlflow.set_tracking_uri(uri="http://192.168.1.90:8080")
+            self.client = MlflowClient()
+            self.registered_model_name = registered_model_name
+            current_prod = self.client.get_model_version_by_alias(registered_model_name, "prod")
+        print(f"Serving run {current_prod.run_id}")
+
+        if INTRA_OP_THREADS > 0:
+            torch.set_num_threads(INTRA_OP_THREADS)
         self.device = device
-        self.model.to(self.device)
-        self.model.eval()
+        self.store = ModelStore(MODEL_CACHE_DIR)
+        self.model = self._load_model(current_prod.run_id, current_prod.version, timings)
 
-    @bentoml.api
-    def predict(
-        self, user_id: int, top_k: int = 10, ranked_movies: np.ndarray = None
-    ) -> np.ndarray:
-        user_id = torch.tensor([user_id], dtype=torch.long).to(self.device)
-        all_items = torch.arange(1, self.model.n_items + 1, dtype=torch.long).to(self.device)
+        self.history = None
+        if HISTORY_PATH:
+            self.history = UserHistoryStore(HISTORY_PATH)
+
+        self.cache = None
+        if CACHE_SIZE > 0:
+            self.cache = RecommendationCache(max_size=CACHE_SIZE, ttl_seconds=CACHE_TTL_SECONDS)
+
+        self.prod_run_id = current_prod.run_id
+        if HOT_SWAP or self.cache is not None:
+            threading.Thread(target=self._watch_prod_alias, daemon=True).start()
 
-        # Remove already ranked movies from the list of all items
+        phases = ", ".join(f"{phase}={seconds:.2f}s" for phase, seconds in timings.items())
+        print(f"Startup took {sum(timings.values()):.2f}s: {phases}")
+
+    def _load_model(self, run_id, version, timings):
+        # Weights are memory-mapped from the local cache, only the first load of a run downloads them
+        with timed("load_weights", timings):
+            weights = self.store.weights(run_id, MODEL_FORMAT)
+
+        compiled = None
+        if MODEL_FORMAT == "torchscript":
+            with timed("load_torchscript", timings):
+                compiled_path = self.store.artifact(run_id, "inference/model.pt")
+                compiled = torch.jit.load(compiled_path, map_location=self.device)
+
+        with timed("build_scorer", timings):
+            # Request threads keep the scratch buffers they allocated for the previous model
+            previous = getattr(self, "model", None)
+            scratch = None if previous is None else previous.scorer._scratch
+            scorer = ItemTowerScorer(weights, device=self.device, compiled=compiled, scratch=scratch)
+
+        # Runs on the loading thread: it faults the tables in and runs the kernels once, the scratch buffers
+        # of the request threads are their own
+        with timed("warmup", timings):
+            scorer.page_in()
+            user_id = torch.ones(1, dtype=torch.long)
+            for _ in range(WARMUP_ITERATIONS):
+                scorer.score(user_id)
+
+        index = None
+        if RETRIEVAL_MODE == "ann":
+            with timed("build_ann_index", timings):
+                index = IVFIndex(scorer.item_vectors().cpu().numpy(), n_lists=ANN_LISTS)
+
+        precomputed = None
+        if USE_PRECOMPUTED:
+            with timed("load_precomputed", timings):
+                precomputed = self._load_precomputed(run_id)
+
+        return ServedModel(run_id, version, scorer, index=index, precomputed=precomputed)
+
+    def _load_precomputed(self, run_id):
+        try:
+            path = self.store.artifact(run_id, "recommendations/top_k.npy")
+        except Exception as e:
+            print(f"No precomputed recommendations for run {run_id}: {e}")
+            return None
+        return np.load(path, mmap_mode="r")
+
+    @staticmethod
+    def _lookup_precomputed(model, user_id, top_k, ranked_movies):
+        if model.precomputed is None or not 0 <= user_id < model.precomputed.shape[0]:
+            return None
+        recommended_items = model.precomputed[user_id]
         if ranked_movies is not None:
-            ranked_movie_present_counter.inc()
-            ranked_movies = torch.tensor(ranked_movies, dtype=torch.long).to(
+            recommended_items = recommended_items[
+                ~np.isin(recommended_items, ranked_movies)
+            ]
+        # The table holds the exact ranking, so any prefix of it is the exact top k
+        if recommended_items.shape[0] < top_k:
+            return None
+        return np.array(recommended_items[:top_k], dtype=np.int64)
+
+    def _recommend(self, model, user_id, top_k, ranked_movies):
+        stages = StageTimer(model.version)
+        user_id = torch.tensor([user_id], dtype=torch.long)
+        scorer = model.scorer
+        if ranked_movies is not None:
+            ranked_movies = torch.as_tensor(ranked_movies, dtype=torch.long).to(
                 self.device
             )
-            unrated_items = all_items[~torch.isin(all_items, ranked_movies)]
+        stages.lap("tensor_construction")
+
+        if model.index is None:
+            # Predict ratings for all items
+            all_items = scorer.item_ids
+        else:
+            # Retrieve candidates by inner product and re-rank them with the full model head
+            n_candidates = ANN_CANDIDATES
+            if ranked_movies is not None:
+                n_candidates += len(ranked_movies)
+            query = scorer.user_vectors(user_id)[0].cpu().numpy()
+            candidates = model.index.search(query, n_candidates, ANN_PROBES)
+            all_items = torch.from_numpy(candidates).to(self.device)
+            stages.lap("candidate_retrieval")
+        candidate_count_histogram.labels(model_version=model.version).observe(all_items.shape[0])
+
+        if model.index is None:
+            predictions = scorer.score(user_id)[0]
+        else:
+            predictions = scorer.score(user_id, items=all_items)[0]
+        stages.lap("forward")
+
+        # Mask already ranked movies in place instead of shrinking the list of items
+        if ranked_movies is not None:
+            ranked_movie_present_counter.inc()
+            if model.index is None:
+                in_catalogue = (ranked_movies >= 1) & (ranked_movies <= scorer.n_items)
+                predictions.index_fill_(0, ranked_movies[in_catalogue] - 1, float("-inf"))
+            else:
+                predictions.masked_fill_(
+                    torch.isin(all_items, ranked_movies), float("-inf")
+                )
+            stages.lap("exclusion")
         else:
             ranked_movie_absent_counter.inc()
-            unrated_items = all_items
 
-        user_ids = user_id.repeat(len(unrated_items))
+        # Get the items with the highest predicted rating
+        top_n = torch.topk(predictions, min(top_k, predictions.shape[0]))
+        top_n_indices = top_n.indices[top_n.values > float("-inf")]
+        stages.lap("topk")
+
+        recommended_items = all_items[top_n_indices].cpu().numpy()
+        stages.lap("numpy_conversion")
+        return recommended_items
+
+    def _watch_prod_alias(self):
+        while True:
+            time.sleep(ALIAS_POLL_SECONDS)
+            try:
+                current_prod = self.client.get_model_version_by_alias(
+                    self.registered_model_name, "prod"
+                )
+            except Exception as e:
+                print(f"Could not resolve the prod alias: {e}")
+                continue
+            if current_prod.run_id == self.prod_run_id:
+                continue
+
+            print(f"prod alias moved to run {current_prod.run_id}")
+            if HOT_SWAP:
+                timings = {}
+                try:
+                    model = self._load_model(
+                        current_prod.run_id, current_prod.version, timings
+                    )
+                except Exception as e:
+                    # Keep serving the current model and retry on the next poll
+                    print(f"Could not load run {current_prod.run_id}: {e}")
+                    continue
+                # Requests already running hold a reference to the previous model and finish on it
+                self.model = model
+                print(f"Swapped to run {model.run_id} after {sum(timings.values()):.2f}s")
+            self.prod_run_id = current_prod.run_id
+            if self.cache is not None:
+                self.cache.clear()
+
+    @bentoml.api
+    def predict(
+        self,
+        user_id: int,
+        top_k: int = 10,
+        ranked_movies: np.ndarray = None,
+        exclude_history: bool = False,
+    ) -> np.ndarray:
+        start = time.perf_counter()
+
+        # Look up the movies the user already ranked instead of receiving them in the payload
+        if exclude_history and self.history is None:
+            raise InvalidArgument(
+                "exclude_history needs a history store, set RECOMMENDER_HISTORY_PATH"
+            )
+        if exclude_history:
+            history = self.history.get(user_id)
+            if ranked_movies is None:
+                ranked_movies = history
+            else:
+                ranked_movies = np.concatenate([np.asarray(ranked_movies), history])
+
+        model = self.model
+        ranked_movies_length_histogram.observe(
+            0 if ranked_movies is None else len(ranked_movies)
+        )
+        recommended_items, source = self._predict(model, user_id, top_k, ranked_movies)
+        request_latency_histogram.labels(
+            endpoint="predict", source=source, model_version=model.version
+        ).observe(time.perf_counter() - start)
+        return recommended_items
+
+    def _predict(self, model, user_id, top_k, ranked_movies):
+        recommended_items = self._lookup_precomputed(model, user_id, top_k, ranked_movies)
+        if recommended_items is not None:
+            return recommended_items, "precomputed"
+
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(model.run_id, user_id, top_k, ranked_movies)
+            recommended_items = self.cache.get(cache_key)
+            if recommended_items is not None:
+                return recommended_items, "cache"
+
+        with torch.inference_mode():
+            recommended_items = self._recommend(model, user_id, top_k, ranked_movies)
+
+        if cache_key is not None:
+            self.cache.put(cache_key, recommended_items)
+
+        return recommended_items, "model"
+
+    @bentoml.api(
+        batchable=True,
+        batch_dim=0,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_latency_ms=MAX_LATENCY_MS,
+    )
+    def predict_batch(self, user_ids: np.ndarray) -> np.ndarray:
+        start = time.perf_counter()
+        model = self.model
+        batch_size_histogram.observe(user_ids.shape[0])
+        if (
+            model.precomputed is not None
+            and BATCH_TOP_K <= model.precomputed.shape[1]
+            and 0 <= user_ids.min()
+            and user_ids.max() < model.precomputed.shape[0]
+        ):
+            recommended_items = np.array(
+                model.precomputed[user_ids.reshape(-1), :BATCH_TOP_K], dtype=np.int64
+            )
+            source = "precomputed"
+        else:
+            stages = StageTimer(model.version)
+            users = torch.as_tensor(user_ids, dtype=torch.long).reshape(-1)
 
-        # Predict ratings for all unrated items
-        with torch.no_grad():
-            predictions = self.model(user_ids, unrated_items).squeeze()
+            # Score the whole adaptive batch in one pass, one row per user
+            predictions = model.scorer.score(users)
+            stages.lap("batch_forward")
 
-        # Get the item with the highest predicted rating
-        top_n_indices = torch.topk(predictions, top_k).indices
-        recommended_items = unrated_items[top_n_indices].cpu().numpy()
+            top_n_indices = torch.topk(predictions, BATCH_TOP_K, dim=1).indices
+            recommended_items = model.scorer.item_ids[top_n_indices].cpu().numpy()
+            stages.lap("batch_topk")
+            source = "model"
 
+        request_latency_histogram.labels(
+            endpoint="predict_batch", source=source, model_version=model.version
+        ).observe(time.perf_counter() - start)
         return recommended_items
@@ -6,8 +6,12 @@ from training_and_validation_components import (
     negative_sampling, get_dataset_metadata,
     get_test_valid_dataset,
     promote_model_to_staging,
+    export_inference_model,
+    quantize_model,
+    precompute_recommendations,
     validate_model,
-    train_model
+    train_model,
+    train_model_ddp
 )
 
 
@@ -18,6 +22,8 @@ from training_and_validation_components import (
 def training_pipeline(
         minio_bucket: str = 'datasets',
         number_of_negative_samples: int = 10,
+        negative_sampling_seed: int = 42,
+        negative_sampling_popularity_exponent: float = 0.0,
         training_dataset_name: str = 'ml-25m',
         training_batch_size: int = 64,
         training_learning_rate: float = 0.001,
@@ -30,6 +36,18 @@ def training_pipeline(
         testing_batch_size: int = 64,
         shuffle_training_data: bool = True,
         shuffle_testing_data: bool = True,
+        dataloader_workers: int = 0,
+        dataloader_prefetch_factor: int = 2,
+        training_embedding_optimizer: str = 'dense',
+        training_metrics_log_every_n_steps: int = 100,
+        training_mixed_precision: str = 'none',
+        training_compile_model: bool = False,
+        training_checkpoint_every_n_epochs: int = 1,
+        training_early_stopping_patience: int = 0,
+        training_early_stopping_min_delta: float = 0.0,
+        training_mlflow_run_id: str = '',
+        training_world_size: int = 1,
+        training_shard_embeddings: bool = False,
         hot_reload_model_id: str = 'none',
         validation_top_k: int = 50,
         validation_threshold: int = 3,
@@ -37,6 +55,10 @@ def training_pipeline(
         model_promote_rms_threshold: float = 0.0001,
         model_promote_precision_threshold: float = -0.3,
         model_promote_recall_threshold: float = -0.2,
+        precompute_top_k: int = 100,
+        precompute_user_batch_size: int = 256,
+        export_block_elements: int = 4194304,
+        quantization_precision: str = 'int8',
         mlflow_experiment_name: str = 'recommender',
         mlflow_registered_model_name: str = 'recommender_production',
         mlflow_uri: str = 'http://mlflow-service.mlflow.svc.cluster.local:5000',
@@ -54,38 +76,84 @@ def training_pipeline(
                     bucket=minio_bucket,
                     dataset_name=training_dataset_name,
                     split='train', 
-                    num_ng_test=number_of_negative_samples).after(dataset_metadata).set_caching_options(False)
+                    num_ng_test=number_of_negative_samples,
+                    seed=negative_sampling_seed,
+                    popularity_exponent=negative_sampling_popularity_exponent).after(dataset_metadata).set_caching_options(False)
 
     aux_data = get_test_valid_dataset(
                 bucket=minio_bucket,
                 dataset_name=training_dataset_name).after(negative_sampled_data).set_caching_options(False)
 
-    training = train_model(
-        mlflow_experiment_name=mlflow_experiment_name,
-        mlflow_run_id="",
-        mlflow_tags={},
-        hot_reload_model_run_id=hot_reload_model_id,
-        model_embedding_factors=model_embedding_factors,
-        model_learning_rate=training_learning_rate,
-        model_hidden_dims=model_hidden_dims,
-        model_dropout_rate=model_dropout_rate,
-        optimizer_step_size=optimizer_step_size,
-        optimizer_gamma=optimizer_gamma,
-        training_epochs=training_epochs,
-        train_batch_size=training_batch_size,
-        test_batch_size=testing_batch_size,
-        training_data=negative_sampled_data.outputs['negative_sampled_dataset'],
-        training_data_metadata=dataset_metadata.output,
-        testing_data=aux_data.outputs['testing_dataset'],
-        shuffle_training_data=shuffle_training_data,
-        shuffle_testing_data=shuffle_testing_data,
-        mlflow_uri=mlflow_uri,
-        AWS_ACCESS_KEY_ID=AWS_ACCESS_KEY_ID, 
-        AWS_SECRET_ACCESS_KEY=AWS_SECRET_ACCESS_KEY, 
-        MLFLOW_S3_ENDPOINT_URL=MLFLOW_S3_ENDPOINT_URL).after(negative_sampled_data).set_caching_options(False)
+    # Data parallel training over world_size gloo processes when more than one is requested
+    with dsl.If(training_world_size > 1, name='distributed-training'):
+        distributed_training = train_model_ddp(
+            mlflow_experiment_name=mlflow_experiment_name,
+            mlflow_run_id=training_mlflow_run_id,
+            mlflow_tags={},
+            hot_reload_model_run_id=hot_reload_model_id,
+            model_embedding_factors=model_embedding_factors,
+            model_learning_rate=training_learning_rate,
+            model_hidden_dims=model_hidden_dims,
+            model_dropout_rate=model_dropout_rate,
+            optimizer_step_size=optimizer_step_size,
+            optimizer_gamma=optimizer_gamma,
+            training_epochs=training_epochs,
+            train_batch_size=training_batch_size,
+            test_batch_size=testing_batch_size,
+            training_data=negative_sampled_data.outputs['negative_sampled_dataset'],
+            training_data_metadata=dataset_metadata.output,
+            testing_data=aux_data.outputs['testing_dataset'],
+            shuffle_training_data=shuffle_training_data,
+            shuffle_testing_data=shuffle_testing_data,
+            world_size=training_world_size,
+            shard_embeddings=training_shard_embeddings,
+            dataloader_workers=dataloader_workers,
+            dataloader_prefetch_factor=dataloader_prefetch_factor,
+            mixed_precision=training_mixed_precision,
+            checkpoint_every_n_epochs=training_checkpoint_every_n_epochs,
+            early_stopping_patience=training_early_stopping_patience,
+            early_stopping_min_delta=training_early_stopping_min_delta,
+            mlflow_uri=mlflow_uri,
+            AWS_ACCESS_KEY_ID=AWS_ACCESS_KEY_ID, 
+            AWS_SECRET_ACCESS_KEY=AWS_SECRET_ACCESS_KEY, 
+            MLFLOW_S3_ENDPOINT_URL=MLFLOW_S3_ENDPOINT_URL).after(negative_sampled_data).set_caching_options(False)
+    with dsl.Else(name='single-process-training'):
+        training = train_model(
+            mlflow_experiment_name=mlflow_experiment_name,
+            mlflow_run_id=training_mlflow_run_id,
+            mlflow_tags={},
+            hot_reload_model_run_id=hot_reload_model_id,
+            model_embedding_factors=model_embedding_factors,
+            model_learning_rate=training_learning_rate,
+            model_hidden_dims=model_hidden_dims,
+            model_dropout_rate=model_dropout_rate,
+            optimizer_step_size=optimizer_step_size,
+            optimizer_gamma=optimizer_gamma,
+            training_epochs=training_epochs,
+            train_batch_size=training_batch_size,
+            test_batch_size=testing_batch_size,
+            training_data=negative_sampled_data.outputs['negative_sampled_dataset'],
+            training_data_metadata=dataset_metadata.output,
+            testing_data=aux_data.outputs['testing_dataset'],
+            shuffle_training_data=shuffle_training_data,
+            shuffle_testing_data=shuffle_testing_data,
+            dataloader_workers=dataloader_workers,
+            dataloader_prefetch_factor=dataloader_prefetch_factor,
+            embedding_optimizer=training_embedding_optimizer,
+            metrics_log_every_n_steps=training_metrics_log_every_n_steps,
+            mixed_precision=training_mixed_precision,
+            compile_model=training_compile_model,
+            checkpoint_every_n_epochs=training_checkpoint_every_n_epochs,
+            early_stopping_patience=training_early_stopping_patience,
+            early_stopping_min_delta=training_early_stopping_min_delta,
+            mlflow_uri=mlflow_uri,
+            AWS_ACCESS_KEY_ID=AWS_ACCESS_KEY_ID, 
+            AWS_SECRET_ACCESS_KEY=AWS_SECRET_ACCESS_KEY, 
+            MLFLOW_S3_ENDPOINT_URL=MLFLOW_S3_ENDPOINT_URL).after(negative_sampled_data).set_caching_options(False)
+    trained_run_id = dsl.OneOf(distributed_training.output, training.output)
 
     val = validate_model(
-        model_run_id=training.output,
+        model_run_id=trained_run_id,
         top_k=validation_top_k,
         threshold=validation_threshold,
         val_batch_size=validation_batch_size,
@@ -93,10 +161,10 @@ def training_pipeline(
         AWS_ACCESS_KEY_ID=AWS_ACCESS_KEY_ID, 
         AWS_SECRET_ACCESS_KEY=AWS_SECRET_ACCESS_KEY, 
         MLFLOW_S3_ENDPOINT_URL=MLFLOW_S3_ENDPOINT_URL,
-        mlflow_uri=mlflow_uri).after(training).set_caching_options(False)
+        mlflow_uri=mlflow_uri).set_caching_options(False)
 
-    promote_model_to_staging(
-        model_run_id=training.output,
+    promote = promote_model_to_staging(
+        model_run_id=trained_run_id,
         registered_model_name=mlflow_registered_model_name,
         top_k=validation_top_k,
         rms_threshold=model_promote_rms_threshold,
@@ -104,6 +172,47 @@ def training_pipeline(
         recall_threshold=model_promote_recall_threshold,
         mlflow_uri=mlflow_uri).after(val).set_caching_options(False)
 
+    export_inference_model(
+        model_run_id=trained_run_id,
+        block_elements=export_block_elements,
+        AWS_ACCESS_KEY_ID=AWS_ACCESS_KEY_ID, 
+        AWS_SECRET_ACCESS_KEY=AWS_SECRET_ACCESS_KEY, 
+        MLFLOW_S3_ENDPOINT_URL=MLFLOW_S3_ENDPOINT_URL,
+        mlflow_uri=mlflow_uri).after(val).set_caching_options(False)
+
+    quantization = quantize_model(
+        model_run_id=trained_run_id,
+        precision=quantization_precision,
+        AWS_ACCESS_KEY_ID=AWS_ACCESS_KEY_ID, 
+        AWS_SECRET_ACCESS_KEY=AWS_SECRET_ACCESS_KEY, 
+        MLFLOW_S3_ENDPOINT_URL=MLFLOW_S3_ENDPOINT_URL,
+        mlflow_uri=mlflow_uri).set_caching_options(False)
+
+    # Same metrics as the float model, logged with a quantized_ prefix for the accuracy report
+    validate_model(
+        model_run_id=trained_run_id,
+        top_k=validation_top_k,
+        threshold=validation_threshold,
+        val_batch_size=validation_batch_size,
+        validation_dataset=aux_data.outputs['validation_dataset'],
+        model_artifact_path='quantized_model',
+        metric_prefix='quantized_',
+        AWS_ACCESS_KEY_ID=AWS_ACCESS_KEY_ID, 
+        AWS_SECRET_ACCESS_KEY=AWS_SECRET_ACCESS_KEY, 
+        MLFLOW_S3_ENDPOINT_URL=MLFLOW_S3_ENDPOINT_URL,
+        mlflow_uri=mlflow_uri).after(quantization).set_caching_options(False)
+
+    # Only a promoted model is worth scoring every user against the whole catalogue
+    with dsl.If(promote.output == True, name='model-promoted'):
+        precompute_recommendations(
+            model_run_id=trained_run_id,
+            top_k=precompute_top_k,
+            user_batch_size=precompute_user_batch_size,
+            AWS_ACCESS_KEY_ID=AWS_ACCESS_KEY_ID, 
+            AWS_SECRET_ACCESS_KEY=AWS_SECRET_ACCESS_KEY, 
+            MLFLOW_S3_ENDPOINT_URL=MLFLOW_S3_ENDPOINT_URL,
+            mlflow_uri=mlflow_uri).after(promote).set_caching_options(False)
+
 
 if __name__ == "__main__":
     kfp.compiler.Compiler().compile(
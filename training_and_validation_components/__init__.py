@@ -1,8 +1,11 @@
 from .data_preprocessing import negative_sampling, get_dataset_metadata, get_test_valid_dataset
 from .data_preprocessing_cuda import negative_sampling_cuda, get_dataset_metadata_cuda, get_test_valid_dataset_cuda
-from .model_registration import promote_model_to_staging
-from .model_registration_cuda import promote_model_to_staging_cuda
+from .model_registration import promote_model_to_staging, export_inference_model, quantize_model
+from .model_registration_cuda import promote_model_to_staging_cuda, export_inference_model_cuda, quantize_model_cuda
+from .batch_recommendations import precompute_recommendations
+from .batch_recommendations_cuda import precompute_recommendations_cuda
 from .model_validation import validate_model
 from .model_validation_cuda import validate_model_cuda
 from .model_training import train_model
-from .model_training_cuda import train_model_cuda
\ No newline at end of file
+from .model_training_cuda import train_model_cuda
+from .model_training_ddp import train_model_ddp
\ No newline at end of file
@@ -0,0 +1,76 @@
+from kfp.dsl import component, Output, Artifact
+
+
+@component(base_image="matichaud/movie-recommender:v1")
+def precompute_recommendations_cuda(
+        model_run_id: str,
+        top_k: int,
+        user_batch_size: int,
+        mlflow_uri: str,
+        AWS_ACCESS_KEY_ID: str,
+        AWS_SECRET_ACCESS_KEY: str,
+        MLFLOW_S3_ENDPOINT_URL: str,
+        recommendations: Output[Artifact]):
+
+    import os
+    import shutil
+    import tempfile
+    import time
+    import numpy as np
+    import torch
+    import mlflow.pytorch
+    import mlflow
+    from mlflow import MlflowClient
+
+    os.environ['AWS_ACCESS_KEY_ID'] = AWS_ACCESS_KEY_ID
+    os.environ['AWS_SECRET_ACCESS_KEY'] = AWS_SECRET_ACCESS_KEY
+    os.environ['MLFLOW_S3_ENDPOINT_URL'] = MLFLOW_S3_ENDPOINT_URL
+    os.environ['MLFLOW_TRACKING_URI'] = mlflow_uri
+
+    mlflow.set_tracking_uri(uri=mlflow_uri)
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"Using device: {device}")
+
+    model = mlflow.pytorch.load_model(f"runs:/{model_run_id}/model")
+    model.to(device)
+    model.eval()
+
+    n_items = model.n_items
+    n_users = model.user_factors.num_embeddings
+    top_k = min(top_k, n_items)
+
+    with torch.no_grad():
+        item_table = model.item_factors.weight[1:n_items + 1].contiguous()
+        user_table = model.user_factors.weight
+        w1 = model.linear.weight
+        b1 = model.linear.bias
+        w2 = model.linear2.weight.reshape(-1)
+    hidden_dim = w1.shape[0]
+    item_block = max(1, (1 << 24) // (user_batch_size * hidden_dim))
+
+    # Rows are indexed by user id and hold item ids, the same ids the serving model uses.
+    table_path = os.path.join(tempfile.mkdtemp(), "top_k.npy")
+    table = np.lib.format.open_memmap(table_path, mode="w+", dtype=np.int32, shape=(n_users, top_k))
+
+    start_time = time.perf_counter()
+    with torch.inference_mode():
+        for start in range(0, n_users, user_batch_size):
+            users = user_table[start:start + user_batch_size]
+            n_block_users = users.shape[0]
+            # linear(u * i) == i @ (W1 * u).T + b1, so a block of users costs one GEMM per block of items
+            folded_w1 = (w1.unsqueeze(0) * users.unsqueeze(1)).permute(2, 0, 1).reshape(-1, n_block_users * hidden_dim)
+            folded_b1 = b1.repeat(n_block_users)
+            scores = torch.empty((n_block_users, n_items), device=device)
+            for item_start in range(0, n_items, item_block):
+                item_end = min(item_start + item_block, n_items)
+                hidden = torch.addmm(folded_b1, item_table[item_start:item_end], folded_w1).relu_()
+                hidden = hidden.view(item_end - item_start, n_block_users, hidden_dim)
+                scores[:, item_start:item_end] = torch.matmul(hidden, w2).t()
+            top_items = torch.topk(scores, top_k, dim=1).indices + 1
+            table[start:start + n_block_users] = top_items.cpu().numpy()
+    table.flush()
+    print(f"Precomputed top {top_k} for {n_users} users in {time.perf_counter() - start_time:.1f}s")
+
+    MlflowClient().log_artifact(model_run_id, table_path, "recommendations")
+    shutil.copyfile(table_path, recommendations.path)
@@ -48,7 +48,16 @@ def get_test_valid_dataset(bucket: str, dataset_name: str, testing_dataset: Outp
 
 
 @component(packages_to_install=["pandas", "fastparquet", "numpy", "pyarrow"])
-def negative_sampling(num_ng_test: int, bucket: str , dataset_name: str, split: str, negative_sampled_dataset: Output[Dataset]):
+def negative_sampling(num_ng_test: int, bucket: str , dataset_name: str, split: str, negative_sampled_dataset: Output[Dataset],
+                      seed: int = 42, popularity_exponent: float = 0.0, max_rounds: int = 100):
+    """
+    Adds num_ng_test unrated movies per user with a rating of 0.
+
+    Candidates for every user are drawn in one vectorized batch and the ones the user already rated are
+    rejected with a binary search in the sorted (user, movie) keys of the ratings. Only the rejected draws
+    are sampled again. popularity_exponent 0 draws movies uniformly, above 0 proportionally to
+    their number of ratings raised to that power.
+    """
     import pandas as pd
     from pyarrow import fs, parquet
     import numpy as np
@@ -60,15 +69,44 @@ def negative_sampling(num_ng_test: int, bucket: str , dataset_name: str, split:
         scheme='http')
     paraquet_data = minio.open_input_file(f'{bucket}/{dataset_name}/{split}.parquet.gzip')
     ratings = parquet.read_table(paraquet_data).to_pandas()
-    item_pool = set(ratings['movieId'].unique())
-    interact_status = (
-            ratings.groupby('userId')['movieId']
-            .apply(set)
-            .reset_index()
-            .rename(columns={'movieId': 'interacted_items'}))
-    interact_status['negative_samples'] = interact_status['interacted_items'].apply(lambda x: np.random.choice(list(item_pool - x), num_ng_test))
-    interact_status['rating'] = 0.0
-    interact_status['timestamp'] = 1051631039
-    interact_status = interact_status.drop(columns=['interacted_items']).explode('negative_samples').rename(columns={'negative_samples':'movieId'})
-    ret = pd.concat([ratings, interact_status], ignore_index=True)
-    pd.to_pickle(ret, negative_sampled_dataset.path)
+
+    users = ratings['userId'].to_numpy()
+    items = ratings['movieId'].to_numpy()
+    item_pool, item_counts = np.unique(items, return_counts=True)
+    user_ids = np.unique(users)
+    key_stride = np.int64(item_pool.max()) + 1
+    interactions = np.unique(users.astype(np.int64) * key_stride + items)
+
+    probabilities = None
+    if popularity_exponent > 0:
+        weights = item_counts.astype(np.float64) ** popularity_exponent
+        probabilities = weights / weights.sum()
+
+    rng = np.random.default_rng(seed)
+    negative_users = np.repeat(user_ids, num_ng_test)
+    negative_items = np.zeros(negative_users.shape[0], dtype=items.dtype)
+    pending = np.arange(negative_users.shape[0])
+    for _ in range(max_rounds):
+        if pending.shape[0] == 0:
+            break
+        candidates = item_pool[rng.choice(item_pool.shape[0], size=pending.shape[0], p=probabilities)]
+        keys = negative_users[pending].astype(np.int64) * key_stride + candidates
+        position = np.minimum(np.searchsorted(interactions, keys), interactions.shape[0] - 1)
+        rated = interactions[position] == keys
+        negative_items[pending[~rated]] = candidates[~rated]
+        pending = pending[rated]
+
+    # Users that rated (almost) every movie can run out of candidates
+    keep = np.ones(negative_users.shape[0], dtype=bool)
+    keep[pending] = False
+    if pending.shape[0] > 0:
+        print(f"Dropped {pending.shape[0]} negative samples without an unrated movie after {max_rounds} rounds")
+
+    negatives = pd.DataFrame({
+        'userId': negative_users[keep].astype(ratings['userId'].dtype),
+        'movieId': negative_items[keep],
+        'rating': np.zeros(int(keep.sum()), dtype=ratings['rating'].dtype),
+        'timestamp': np.full(int(keep.sum()), 1051631039, dtype=ratings['timestamp'].dtype),
+    })
+    ret = pd.concat([ratings, negatives[ratings.columns]], ignore_index=True)
+    ret.to_parquet(negative_sampled_dataset.path, index=False)
@@ -9,7 +9,10 @@ def promote_model_to_staging(
         precision_threshold: float,
         top_k: int,
         recall_threshold: float,
-        mlflow_uri: str):
+        mlflow_uri: str) -> bool:
+    """
+    :return: bool, whether model_run_id is the staging model when the step ends
+    """
 
     import mlflow.pytorch
     import mlflow
@@ -25,9 +28,9 @@ def promote_model_to_staging(
     except RestException:
         print("No staging model found. Auto upgrade current run to staging.")
 
-    if current_staging.run_id == model_run_id:
+    if current_staging is not None and current_staging.run_id == model_run_id:
         print("Input run is already the current staging.")
-        return
+        return True
 
     if current_staging is not None:
         current_staging_model_data = client.get_run(current_staging.run_id).data.to_dictionary()
@@ -37,13 +40,167 @@ def promote_model_to_staging(
         new_model_metrics = new_model_data['metrics']
 
         if (new_model_metrics['rms'] - staging_model_metrics['rms']) > rms_threshold:
-            return
+            print(f"Not promoting {model_run_id}: rms is not within its threshold of the staging model")
+            return False
 
         if (new_model_metrics[f'precision_{top_k}'] - staging_model_metrics[f'precision_{top_k}']) < precision_threshold:
-            return
+            print(f"Not promoting {model_run_id}: precision is not within its threshold of the staging model")
+            return False
 
         if (new_model_metrics[f'recall_{top_k}'] - staging_model_metrics[f'recall_{top_k}']) < recall_threshold:
-            return
+            print(f"Not promoting {model_run_id}: recall is not within its threshold of the staging model")
+            return False
 
     result = mlflow.register_model(f"runs:/{model_run_id}/model", "recommender_production")
     client.set_registered_model_alias("recommender_production", "staging", result.version)
+    return True
+
+
+@component(packages_to_install=["torch", "mlflow", "boto3"],
+           pip_index_urls=["https://download.pytorch.org/whl/cpu", "https://pypi.org/simple", "https://pypi.python.org/simple"])
+def export_inference_model(
+        model_run_id: str,
+        block_elements: int,
+        mlflow_uri: str,
+        AWS_ACCESS_KEY_ID: str,
+        AWS_SECRET_ACCESS_KEY: str,
+        MLFLOW_S3_ENDPOINT_URL: str):
+
+    import os
+    import tempfile
+    from typing import Optional
+    import torch
+    import mlflow.pytorch
+    import mlflow
+    from mlflow import MlflowClient
+
+    os.environ['AWS_ACCESS_KEY_ID'] = AWS_ACCESS_KEY_ID
+    os.environ['AWS_SECRET_ACCESS_KEY'] = AWS_SECRET_ACCESS_KEY
+    os.environ['MLFLOW_S3_ENDPOINT_URL'] = MLFLOW_S3_ENDPOINT_URL
+    os.environ['MLFLOW_TRACKING_URI'] = mlflow_uri
+
+    mlflow.set_tracking_uri(uri=mlflow_uri)
+
+    class CatalogueScorer(torch.nn.Module):
+        # Inference graph of MatrixFactorization without dropout. The user embedding is folded into
+        # the first linear layer, linear(u * i) == i @ (W1 * u).T + b1, so items are scored in blocks
+        # with one addmm each and the relu is applied in place on its output.
+        def __init__(self, model, block_elements: int):
+            super().__init__()
+            self.n_items = model.n_items
+            self.block_elements = block_elements
+            self.register_buffer("user_table", model.user_factors.weight.detach().clone())
+            self.register_buffer("item_table", model.item_factors.weight[1:model.n_items + 1].detach().clone())
+            self.register_buffer("w1", model.linear.weight.detach().clone())
+            self.register_buffer("b1", model.linear.bias.detach().clone())
+            self.register_buffer("w2", model.linear2.weight.detach().reshape(-1).clone())
+            self.register_buffer("b2", model.linear2.bias.detach().clone())
+
+        def forward(self, user_ids: torch.Tensor, items: Optional[torch.Tensor] = None) -> torch.Tensor:
+            n_users = user_ids.shape[0]
+            hidden_dim = self.w1.shape[0]
+            folded_w1 = self.w1.unsqueeze(0) * self.user_table[user_ids].unsqueeze(1)
+            folded_w1 = folded_w1.permute(2, 0, 1).reshape(-1, n_users * hidden_dim)
+            folded_b1 = self.b1.repeat(n_users)
+
+            item_table = self.item_table
+            if items is not None:
+                item_table = item_table[items - 1]
+
+            n_rows = item_table.shape[0]
+            scores = torch.empty((n_users, n_rows), dtype=self.w1.dtype, device=self.w1.device)
+            block = max(1, self.block_elements // (n_users * hidden_dim))
+            for start in range(0, n_rows, block):
+                end = min(start + block, n_rows)
+                hidden = torch.addmm(folded_b1, item_table[start:end], folded_w1).relu_()
+                scores[:, start:end] = torch.matmul(hidden.view(end - start, n_users, hidden_dim), self.w2).t()
+            return scores + self.b2
+
+    model = mlflow.pytorch.load_model(f"runs:/{model_run_id}/model")
+    model.to("cpu")
+    model.eval()
+
+    scripted = torch.jit.script(CatalogueScorer(model, block_elements).eval())
+    scripted = torch.jit.freeze(scripted, preserved_attrs=["user_table", "item_table", "n_items"])
+
+    # Check the exported graph against the eager model before logging it
+    with torch.no_grad():
+        users = torch.arange(1, min(8, model.user_factors.num_embeddings), dtype=torch.long)
+        items = torch.arange(1, min(4096, model.n_items) + 1, dtype=torch.long)
+        expected = model(users.repeat_interleave(items.shape[0]), items.repeat(users.shape[0]))
+        max_error = (scripted(users, items).reshape(-1) - expected.reshape(-1)).abs().max().item()
+    print(f"Max absolute difference against the eager model: {max_error:.2e}")
+
+    export_path = os.path.join(tempfile.mkdtemp(), "model.pt")
+    torch.jit.save(scripted, export_path)
+    client = MlflowClient()
+    client.log_artifact(model_run_id, export_path, "inference")
+    client.log_metric(model_run_id, "inference_export_max_error", max_error)
+
+
+@component(packages_to_install=["torch", "mlflow", "boto3"],
+           pip_index_urls=["https://download.pytorch.org/whl/cpu", "https://pypi.org/simple", "https://pypi.python.org/simple"])
+def quantize_model(
+        model_run_id: str,
+        precision: str,
+        mlflow_uri: str,
+        AWS_ACCESS_KEY_ID: str,
+        AWS_SECRET_ACCESS_KEY: str,
+        MLFLOW_S3_ENDPOINT_URL: str):
+
+    import copy
+    import os
+    import tempfile
+    import torch
+    import mlflow.pytorch
+    import mlflow
+
+    os.environ['AWS_ACCESS_KEY_ID'] = AWS_ACCESS_KEY_ID
+    os.environ['AWS_SECRET_ACCESS_KEY'] = AWS_SECRET_ACCESS_KEY
+    os.environ['MLFLOW_S3_ENDPOINT_URL'] = MLFLOW_S3_ENDPOINT_URL
+    os.environ['MLFLOW_TRACKING_URI'] = mlflow_uri
+
+    mlflow.set_tracking_uri(uri=mlflow_uri)
+
+    if precision not in ("int8", "fp16"):
+        raise ValueError(f"Unsupported precision {precision}, expected int8 or fp16")
+
+    model = mlflow.pytorch.load_model(f"runs:/{model_run_id}/model", map_location="cpu")
+    model.eval()
+
+    def quantize(table):
+        if precision == "fp16":
+            quantized = table.half()
+            return quantized, None, quantized.float()
+        # Symmetric per-row int8, one float scale per embedding row
+        scale = table.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+        quantized = torch.round(table / scale.unsqueeze(1)).clamp(-127, 127).to(torch.int8)
+        return quantized, scale, quantized.float() * scale.unsqueeze(1)
+
+    # The linear layers are kept in float: they hold a tiny share of the parameters and the
+    # serving scorer rescales the first one by the user embedding on every request.
+    weights = {"n_items": model.n_items}
+    weights.update({k: v for k, v in model.state_dict().items() if k.startswith("linear")})
+    simulated = copy.deepcopy(model)
+    with torch.no_grad():
+        for name in ("user_factors", "item_factors"):
+            table = getattr(model, name).weight.detach()
+            quantized, scale, dequantized = quantize(table)
+            weights[name] = quantized
+            weights[f"{name}_scale"] = scale
+            getattr(simulated, name).weight.copy_(dequantized)
+            print(f"{name}: max absolute error {(dequantized - table).abs().max().item():.2e}")
+
+    float_bytes = sum(t.numel() * t.element_size() for t in model.state_dict().values())
+    quantized_bytes = sum(t.numel() * t.element_size() for t in weights.values() if isinstance(t, torch.Tensor))
+
+    weights_path = os.path.join(tempfile.mkdtemp(), "weights.pt")
+    torch.save(weights, weights_path)
+
+    # The simulated model has the served precision and is what validate_model scores for the accuracy report
+    with mlflow.start_run(run_id=model_run_id):
+        mlflow.log_artifact(weights_path, "quantized")
+        mlflow.pytorch.log_model(simulated, "quantized_model")
+        mlflow.log_param("quantization_precision", precision)
+        mlflow.log_metric("float_model_mb", float_bytes / 2**20)
+        mlflow.log_metric("quantized_model_mb", quantized_bytes / 2**20)
@@ -2,7 +2,7 @@ from typing import Dict
 from kfp.dsl import component, Input, Dataset
 
 
-@component(packages_to_install=["torch", "torchvision", "torchaudio", "mlflow", "torchinfo" ,"pandas", "boto3"],
+@component(packages_to_install=["torch", "torchvision", "torchaudio", "mlflow", "torchinfo" ,"pandas", "pyarrow", "boto3"],
            pip_index_urls=["https://download.pytorch.org/whl/cpu", "https://pypi.org/simple", "https://pypi.python.org/simple"])
 def train_model(mlflow_experiment_name: str, mlflow_run_id: str, mlflow_tags: dict, mlflow_uri: str,
                 hot_reload_model_run_id: str, training_data: Input[Dataset], training_data_metadata: Dict[str, int],
@@ -11,7 +11,12 @@ def train_model(mlflow_experiment_name: str, mlflow_run_id: str, mlflow_tags: di
                 optimizer_step_size: float, optimizer_gamma: float,
                 training_epochs: int,
                 train_batch_size: int, test_batch_size: int, shuffle_training_data: bool, shuffle_testing_data: bool,
-                AWS_ACCESS_KEY_ID:str, AWS_SECRET_ACCESS_KEY:str, MLFLOW_S3_ENDPOINT_URL:str) -> str:
+                AWS_ACCESS_KEY_ID:str, AWS_SECRET_ACCESS_KEY:str, MLFLOW_S3_ENDPOINT_URL:str,
+                dataloader_workers: int = 0, dataloader_prefetch_factor: int = 2,
+                embedding_optimizer: str = "dense", metrics_log_every_n_steps: int = 100,
+                mixed_precision: str = "none", compile_model: bool = False,
+                checkpoint_every_n_epochs: int = 1, early_stopping_patience: int = 0,
+                early_stopping_min_delta: float = 0.0) -> str:
     input_params = {}
     for k, v in locals().items():
         if k == 'input_params':
@@ -22,24 +27,81 @@ def train_model(mlflow_experiment_name: str, mlflow_run_id: str, mlflow_tags: di
     import mlflow
     from torchinfo import summary
     from mlflow.models import infer_signature
+    from mlflow.entities import Metric
+    import time
+    import tempfile
+    import shutil
     from torch.utils.data import Dataset
     import pandas as pd
 
     class datasetReader(Dataset):
+        """
+        Columns are converted once to contiguous tensors and whole batches are gathered by index,
+        so no pandas row access or per-sample collation happens in the training loop.
+        """
         def __init__(self, df, dataset_name):
-            self.df = df
+            super().__init__()
             self.name = dataset_name
-            print(f"{self.name} : {self.df.shape[0]}")
+            self.users = torch.from_numpy(df['userId'].to_numpy(dtype='int64') - 1)
+            self.items = torch.from_numpy(df['movieId'].to_numpy(dtype='int64') - 1)
+            self.ratings = torch.from_numpy(df['rating'].to_numpy(dtype='float32'))
+            print(f"{self.name} : {self.users.shape[0]}")
 
         def __len__(self):
-            return self.df.shape[0]
+            return self.users.shape[0]
 
         def __getitem__(self, idx):
-            sd = self.df.iloc[idx]
-            user = sd['userId']
-            item = sd['movieId']
-            rating = sd['rating']
-            return torch.tensor(user-1).long(), torch.tensor(item-1).long(), torch.tensor(rating).float()
+            batch = self.users[idx], self.items[idx], self.ratings[idx]
+            if isinstance(idx, slice) and torch.utils.data.get_worker_info() is not None:
+                # A view would hand the whole column storage to the main process through shared memory
+                batch = tuple(t.clone() for t in batch)
+            return batch
+
+    class batchSampler:
+        """
+        Yields the indexes of a whole batch at a time, used with DataLoader(batch_size=None).
+        Unshuffled batches are slices, so they are views on the dataset tensors (copies in loader workers).
+        """
+        def __init__(self, n_rows, batch_size, shuffle):
+            self.n_rows = n_rows
+            self.batch_size = batch_size
+            self.shuffle = shuffle
+
+        def __len__(self):
+            return (self.n_rows + self.batch_size - 1) // self.batch_size
+
+        def __iter__(self):
+            order = torch.randperm(self.n_rows) if self.shuffle else None
+            for start in range(0, self.n_rows, self.batch_size):
+                end = min(start + self.batch_size, self.n_rows)
+                yield slice(start, end) if order is None else order[start:end]
+
+    class metricsLogger:
+        """
+        Keeps the running training loss detached on the training device and sends metrics to MLflow
+        in non-blocking batches, so the loop only waits for the device once every log_every_n_steps.
+        """
+        def __init__(self, run_id, log_every_n_steps, device="cpu"):
+            self.client = mlflow.MlflowClient()
+            self.run_id = run_id
+            self.log_every_n_steps = log_every_n_steps
+            self.window_loss = torch.zeros((), device=device)
+            self.window_steps = 0
+            self.step = 0
+
+        def update(self, loss):
+            self.window_loss += loss.detach()
+            self.window_steps += 1
+            self.step += 1
+            if self.window_steps == self.log_every_n_steps:
+                self.log({"training_loss": self.window_loss.item() / self.window_steps}, step=self.step)
+                self.window_loss.zero_()
+                self.window_steps = 0
+
+        def log(self, metrics, step):
+            timestamp = int(time.time() * 1000)
+            self.client.log_batch(self.run_id, metrics=[Metric(k, float(v), timestamp, step) for k, v in metrics.items()],
+                                  synchronous=False)
 
     class MatrixFactorization(torch.nn.Module):
         def __init__(self, n_users, n_items, n_factors, hidden_dim, dropout_rate):
@@ -66,7 +128,7 @@ def train_model(mlflow_experiment_name: str, mlflow_run_id: str, mlflow_tags: di
             rating = self.linear2(x)
             return rating
 
-    train_dataset = datasetReader(pd.read_pickle(training_data.path), dataset_name='train')
+    train_dataset = datasetReader(pd.read_parquet(training_data.path), dataset_name='train')
     test_dataset = datasetReader(pd.read_pickle(testing_data.path), dataset_name='test')
 
     n_users = training_data_metadata['n_users']
@@ -81,11 +143,41 @@ def train_model(mlflow_experiment_name: str, mlflow_run_id: str, mlflow_tags: di
     else:
         model = MatrixFactorization(n_users, n_items, n_factors=model_embedding_factors, hidden_dim=model_hidden_dims, dropout_rate=model_dropout_rate)
 
-    optimizer = torch.optim.SGD(model.parameters(), lr=model_learning_rate)
-    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=optimizer_step_size, gamma=optimizer_gamma)
+    # Sparse embedding gradients only hold the rows a batch touches instead of both full tables
+    if embedding_optimizer not in ("dense", "sparse_sgd", "sparse_adam"):
+        raise ValueError(f"Unknown embedding_optimizer: {embedding_optimizer}")
+    sparse_embeddings = embedding_optimizer != "dense"
+    model.user_factors.sparse = sparse_embeddings
+    model.item_factors.sparse = sparse_embeddings
+    if embedding_optimizer == "sparse_adam":
+        embedding_parameters = [model.user_factors.weight, model.item_factors.weight]
+        head_parameters = [p for name, p in model.named_parameters() if not name.startswith(("user_factors.", "item_factors."))]
+        optimizers = [torch.optim.SparseAdam(embedding_parameters, lr=model_learning_rate),
+                      torch.optim.SGD(head_parameters, lr=model_learning_rate)]
+    else:
+        # SGD applies sparse gradients as they are
+        optimizers = [torch.optim.SGD(model.parameters(), lr=model_learning_rate)]
+    schedulers = [torch.optim.lr_scheduler.StepLR(optimizer, step_size=optimizer_step_size, gamma=optimizer_gamma)
+                  for optimizer in optimizers]
     loss_func = torch.nn.L1Loss()
-    train_dataloader = DataLoader(train_dataset, batch_size=train_batch_size, shuffle=shuffle_training_data)
-    test_dataloader = DataLoader(test_dataset, batch_size=test_batch_size, shuffle=shuffle_testing_data)
+
+    if mixed_precision not in ("none", "bf16"):
+        raise ValueError(f"Unsupported mixed_precision on CPU: {mixed_precision}")
+    autocast_dtype = torch.bfloat16 if mixed_precision == "bf16" else None
+    # The compiled module shares its parameters with model, which is still the one logged to MLflow
+    forward_model = torch.compile(model) if compile_model else model
+
+    # Worker processes build batches ahead of the training loop and hand them over through shared memory
+    loader_options = {}
+    if dataloader_workers > 0:
+        loader_options.update(num_workers=dataloader_workers, prefetch_factor=dataloader_prefetch_factor,
+                              persistent_workers=True)
+    train_dataloader = DataLoader(train_dataset, batch_size=None,
+                                  sampler=batchSampler(len(train_dataset), train_batch_size, shuffle_training_data),
+                                  **loader_options)
+    test_dataloader = DataLoader(test_dataset, batch_size=None,
+                                 sampler=batchSampler(len(test_dataset), test_batch_size, shuffle_testing_data),
+                                 **loader_options)
 
     import os
     os.environ['AWS_ACCESS_KEY_ID'] = AWS_ACCESS_KEY_ID
@@ -104,64 +196,140 @@ def train_model(mlflow_experiment_name: str, mlflow_run_id: str, mlflow_tags: di
 
     with mlflow.start_run(run_id=mlflow_run_id) as run:
         current_run_id = run.info.run_id
-        for k, v in input_params.items():
-            if 'mlflow_' not in k:
-                mlflow.log_param(k, v)
-        mlflow.log_param("loss_function", loss_func.__class__.__name__)
-        mlflow.log_param("optimizer", "SGD")
-        mlflow.log_params({'n_user': n_users, 'n_items': n_items})
+        # Re-running with the mlflow_run_id of an interrupted run continues from its last checkpoint. Its params are
+        # already logged, and MLflow refuses new values for them (the dataset artifacts differ on every pipeline run)
+        resuming = mlflow_run_id is not None and bool(mlflow.MlflowClient().list_artifacts(current_run_id, "checkpoints"))
+        if not resuming:
+            for k, v in input_params.items():
+                if 'mlflow_' not in k:
+                    mlflow.log_param(k, v)
+            mlflow.log_param("loss_function", loss_func.__class__.__name__)
+            mlflow.log_param("optimizer", "+".join(optimizer.__class__.__name__ for optimizer in optimizers))
+            mlflow.log_params({'n_user': n_users, 'n_items': n_items})
+
+            for k, v in mlflow_tags.items():
+                mlflow.set_tag(k, v)
+
+            with open("model_summary.txt", "w", encoding="utf-8") as f:
+                f.write(str(summary(model)))
+            mlflow.log_artifact("model_summary.txt")
 
-        for k, v in mlflow_tags.items():
-            mlflow.set_tag(k, v)
+        metrics_logger = metricsLogger(current_run_id, metrics_log_every_n_steps, "cpu")
 
-        with open("model_summary.txt", "w", encoding="utf-8") as f:
-            f.write(str(summary(model)))
-        mlflow.log_artifact("model_summary.txt")
+        def save_checkpoint(epoch):
+            checkpoint = {
+                "epoch": epoch,
+                "step": metrics_logger.step,
+                "model": model.state_dict(),
+                "optimizers": [optimizer.state_dict() for optimizer in optimizers],
+                "schedulers": [scheduler.state_dict() for scheduler in schedulers],
+                "rng": torch.get_rng_state(),
+                "best_testing_loss": best_testing_loss,
+                "epochs_without_improvement": epochs_without_improvement,
+            }
+            checkpoint_dir = tempfile.mkdtemp()
+            torch.save(checkpoint, os.path.join(checkpoint_dir, "last.pt"))
+            mlflow.log_artifact(os.path.join(checkpoint_dir, "last.pt"), "checkpoints")
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
 
-        model_signature = None
+        start_epoch = 0
+        best_testing_loss = float("inf")
+        epochs_without_improvement = 0
+        if resuming:
+            checkpoint_path = mlflow.artifacts.download_artifacts(run_id=current_run_id, artifact_path="checkpoints/last.pt")
+            checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+            model.load_state_dict(checkpoint["model"])
+            for optimizer, state in zip(optimizers, checkpoint["optimizers"]):
+                optimizer.load_state_dict(state)
+            for scheduler, state in zip(schedulers, checkpoint["schedulers"]):
+                scheduler.load_state_dict(state)
+            torch.set_rng_state(checkpoint["rng"])
+            metrics_logger.step = checkpoint["step"]
+            best_testing_loss = checkpoint["best_testing_loss"]
+            epochs_without_improvement = checkpoint["epochs_without_improvement"]
+            start_epoch = checkpoint["epoch"] + 1
+            print(f"Resuming from epoch {start_epoch}")
+            if early_stopping_patience > 0 and epochs_without_improvement >= early_stopping_patience:
+                # The interrupted run had already stopped early, only the model is left to log
+                start_epoch = training_epochs
 
-        for train_iter in range(training_epochs):
+        avg_training_loss = None
+        avg_testing_loss = None
+        for train_iter in range(start_epoch, training_epochs):
             print(train_iter)
             model.train()
-            t_loss = 0
+            t_loss = torch.zeros((), device="cpu")
             t_count = 0
+            t_samples = 0
+            epoch_start = time.perf_counter()
             for row, col, rating in train_dataloader:
                 # Predict and calculate loss
-                prediction = model(row, col)
-                if model_signature is None:
-                    model_signature = infer_signature(
-                        {
-                            'user': row.cpu().detach().numpy(),
-                            'movie': col.cpu().detach().numpy()
-                        },
-                        prediction.cpu().detach().numpy()
-                    )
-
-                loss = loss_func(prediction, rating.unsqueeze(1))
-                t_loss += loss
+                with torch.autocast(device_type="cpu", dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                    prediction = forward_model(row, col)
+                loss = loss_func(prediction.float(), rating.unsqueeze(1))
+                # Detached, so the running sum does not keep the graph of every step alive
+                t_loss += loss.detach()
                 t_count += 1
+                t_samples += row.shape[0]
+                metrics_logger.update(loss)
 
                 # Backpropagate
                 loss.backward()
 
                 # Update the parameters
-                optimizer.step()
-                optimizer.zero_grad()
-            mlflow.log_metric("avg_training_loss", f"{(t_loss/t_count):3f}", step=train_iter)
-            scheduler.step()
+                for optimizer in optimizers:
+                    optimizer.step()
+                    optimizer.zero_grad()
+            avg_training_loss = (t_loss / t_count).item()
+            epoch_seconds = time.perf_counter() - epoch_start
+            for scheduler in schedulers:
+                scheduler.step()
             model.eval()
-            te_loss = 0
+            te_loss = torch.zeros((), device="cpu")
             te_count = 0
             print('Evaluating')
             with torch.no_grad():
                 for row, col, rating in test_dataloader:
-                    prediction = model(row, col)
-                    loss = loss_func(prediction, rating.unsqueeze(1))
+                    with torch.autocast(device_type="cpu", dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                        prediction = forward_model(row, col)
+                    loss = loss_func(prediction.float(), rating.unsqueeze(1))
                     te_loss += loss
                     te_count += 1
-            mlflow.log_metric("avg_testing_loss", f"{(te_loss/te_count):3f}", step=train_iter)
-            print(f"Test loss: {te_loss/te_count}")
-            print(f"Train loss: {t_loss/t_count}")
+            avg_testing_loss = (te_loss / te_count).item()
+            metrics_logger.log({
+                "avg_training_loss": avg_training_loss,
+                "avg_testing_loss": avg_testing_loss,
+                "training_steps_per_second": t_count / epoch_seconds,
+                "training_samples_per_second": t_samples / epoch_seconds,
+            }, step=train_iter)
+            print(f"Test loss: {avg_testing_loss}")
+            print(f"Train loss: {avg_training_loss}")
+
+            if avg_testing_loss < best_testing_loss - early_stopping_min_delta:
+                best_testing_loss = avg_testing_loss
+                epochs_without_improvement = 0
+            else:
+                epochs_without_improvement += 1
+            stop = early_stopping_patience > 0 and epochs_without_improvement >= early_stopping_patience
+
+            if checkpoint_every_n_epochs > 0 and ((train_iter + 1) % checkpoint_every_n_epochs == 0 or stop):
+                save_checkpoint(train_iter)
+            if stop:
+                print(f"No improvement of the testing loss in {epochs_without_improvement} epochs, stopping")
+                mlflow.log_metric("early_stopping_epoch", train_iter)
+                break
+
+        if avg_training_loss is not None:
+            metrics_logger.log({"final_training_loss": avg_training_loss, "final_testing_loss": avg_testing_loss},
+                               step=train_iter)
+
+        # The signature only needs one batch, so it is inferred once after training
+        model.eval()
+        row, col, _ = train_dataset[slice(0, min(len(train_dataset), train_batch_size))]
+        with torch.no_grad():
+            prediction = model(row, col)
+        model_signature = infer_signature({'user': row.numpy(), 'movie': col.numpy()}, prediction.cpu().numpy())
 
+        mlflow.flush_async_logging()
         mlflow.pytorch.log_model(model, "model", signature=model_signature)
     return current_run_id
@@ -0,0 +1,435 @@
+from typing import Dict
+from kfp.dsl import component, Input, Dataset
+
+
+@component(packages_to_install=["torch", "torchvision", "torchaudio", "mlflow", "pandas", "pyarrow", "boto3"],
+           pip_index_urls=["https://download.pytorch.org/whl/cpu", "https://pypi.org/simple", "https://pypi.python.org/simple"])
+def train_model_ddp(mlflow_experiment_name: str, mlflow_run_id: str, mlflow_tags: dict, mlflow_uri: str,
+                hot_reload_model_run_id: str, training_data: Input[Dataset], training_data_metadata: Dict[str, int],
+                testing_data: Input[Dataset],
+                model_embedding_factors: int, model_learning_rate: float, model_hidden_dims: int, model_dropout_rate: float,
+                optimizer_step_size: float, optimizer_gamma: float,
+                training_epochs: int,
+                train_batch_size: int, test_batch_size: int, shuffle_training_data: bool, shuffle_testing_data: bool,
+                AWS_ACCESS_KEY_ID:str, AWS_SECRET_ACCESS_KEY:str, MLFLOW_S3_ENDPOINT_URL:str,
+                world_size: int = 2, shard_embeddings: bool = False, master_port: int = 29500,
+                dataloader_workers: int = 0, dataloader_prefetch_factor: int = 2, mixed_precision: str = "none",
+                checkpoint_every_n_epochs: int = 1, early_stopping_patience: int = 0,
+                early_stopping_min_delta: float = 0.0) -> str:
+    """
+    Data parallel train_model over the gloo backend.
+
+    When RANK and WORLD_SIZE are set (torchrun, or a PyTorchJob with one pod per rank) the component runs as that rank.
+    Otherwise it forks world_size ranks in the pod. Every rank trains on an equal shard of the training data.
+    With shard_embeddings the user and item tables are split by rows across ranks instead of being replicated,
+    and no rank holds a full table except rank 0 when it loads or logs a model.
+    Rank 0 logs to MLflow and returns the run id. Checkpoints hold the full tables like those of train_model, so an
+    interrupted run can be resumed with any world size by passing its mlflow_run_id.
+    """
+    input_params = {}
+    for k, v in locals().items():
+        if k == 'input_params':
+            continue
+        input_params[k] = v
+    import os
+    import shutil
+    import tempfile
+    import torch
+    import torch.distributed as dist
+    import torch.multiprocessing as mp
+    from torch.nn.parallel import DistributedDataParallel
+    from torch.utils.data import DataLoader, Dataset
+    import mlflow
+    from mlflow.models import infer_signature
+    import pandas as pd
+
+    class datasetReader(Dataset):
+        """
+        Columns are converted once to contiguous tensors and whole batches are gathered by index,
+        so no pandas row access or per-sample collation happens in the training loop.
+        """
+        def __init__(self, df, dataset_name):
+            super().__init__()
+            self.name = dataset_name
+            self.users = torch.from_numpy(df['userId'].to_numpy(dtype='int64') - 1)
+            self.items = torch.from_numpy(df['movieId'].to_numpy(dtype='int64') - 1)
+            self.ratings = torch.from_numpy(df['rating'].to_numpy(dtype='float32'))
+            print(f"{self.name} : {self.users.shape[0]}")
+
+        def __len__(self):
+            return self.users.shape[0]
+
+        def __getitem__(self, idx):
+            batch = self.users[idx], self.items[idx], self.ratings[idx]
+            if isinstance(idx, slice) and torch.utils.data.get_worker_info() is not None:
+                # A view would hand the whole column storage to the main process through shared memory
+                batch = tuple(t.clone() for t in batch)
+            return batch
+
+    class batchSampler:
+        """
+        Yields the indexes of a whole batch at a time, used with DataLoader(batch_size=None).
+        Unshuffled batches are slices, so they are views on the dataset tensors (copies in loader workers).
+        """
+        def __init__(self, n_rows, batch_size, shuffle):
+            self.n_rows = n_rows
+            self.batch_size = batch_size
+            self.shuffle = shuffle
+
+        def __len__(self):
+            return (self.n_rows + self.batch_size - 1) // self.batch_size
+
+        def __iter__(self):
+            order = torch.randperm(self.n_rows) if self.shuffle else None
+            for start in range(0, self.n_rows, self.batch_size):
+                end = min(start + self.batch_size, self.n_rows)
+                yield slice(start, end) if order is None else order[start:end]
+
+    class MatrixFactorization(torch.nn.Module):
+        def __init__(self, n_users, n_items, n_factors, hidden_dim, dropout_rate, user_factors=None, item_factors=None):
+            super().__init__()
+            self.n_items = n_items
+            self.user_factors = user_factors if user_factors is not None else torch.nn.Embedding(n_users+1,
+                                               n_factors,
+                                               sparse=False)
+            self.item_factors = item_factors if item_factors is not None else torch.nn.Embedding(n_items+1,
+                                               n_factors,
+                                               sparse=False)
+
+            self.linear = torch.nn.Linear(in_features=n_factors, out_features=hidden_dim)
+            self.linear2 = torch.nn.Linear(in_features=hidden_dim, out_features=1)
+            self.dropout = torch.nn.Dropout(p=dropout_rate)
+            self.relu = torch.nn.ReLU()
+
+        def forward(self, user, item):
+            user_embedding = self.user_factors(user)
+            item_embedding = self.item_factors(item)
+            embeddding_vector = torch.mul(user_embedding, item_embedding)
+            x = self.relu(self.linear(embeddding_vector))
+            x = self.dropout(x)
+            rating = self.linear2(x)
+            return rating
+
+    class shardedLookup(torch.autograd.Function):
+        """
+        Lookup in a table split by rows across ranks. Every rank gathers the indexes of all ranks, fills in
+        the rows it owns and an all_reduce assembles the lookups. gloo has no all_to_all, so the backward pass
+        all_gathers the output gradients and each rank keeps those of its own rows.
+        All ranks must call it with batches of the same size.
+        """
+        @staticmethod
+        def forward(ctx, weight, indices, row_offset):
+            gathered = [torch.empty_like(indices) for _ in range(dist.get_world_size())]
+            dist.all_gather(gathered, indices.contiguous())
+            local = torch.cat(gathered) - row_offset
+            owned = (local >= 0) & (local < weight.shape[0])
+            rows = weight.new_zeros((local.shape[0], weight.shape[1]))
+            rows[owned] = weight[local[owned]]
+            dist.all_reduce(rows)
+            ctx.save_for_backward(local, owned)
+            ctx.n_rows = weight.shape[0]
+            rank, n = dist.get_rank(), indices.shape[0]
+            return rows[rank * n:(rank + 1) * n]
+
+        @staticmethod
+        def backward(ctx, grad_output):
+            local, owned = ctx.saved_tensors
+            world_size = dist.get_world_size()
+            gathered = [torch.empty_like(grad_output) for _ in range(world_size)]
+            dist.all_gather(gathered, grad_output.contiguous())
+            grad_weight = grad_output.new_zeros((ctx.n_rows, grad_output.shape[1]))
+            # Averaged over ranks like the gradients DDP reduces for the replicated parameters
+            grad_weight.index_add_(0, local[owned], torch.cat(gathered)[owned], alpha=1.0 / world_size)
+            return grad_weight, None, None
+
+    class shardedEmbedding(torch.nn.Module):
+        def __init__(self, num_embeddings, embedding_dim, seed, block_rows=65536):
+            """
+            Only the rows of this rank are allocated. They are drawn from N(0, 1) like torch.nn.Embedding, with a
+            generator seeded per block of block_rows global rows, so the table is the same for any world size.
+            """
+            super().__init__()
+            world_size, rank = dist.get_world_size(), dist.get_rank()
+            self.num_embeddings = num_embeddings
+            self.rows_per_rank = (num_embeddings + world_size - 1) // world_size
+            self.row_offset = rank * self.rows_per_rank
+            local = torch.zeros((self.rows_per_rank, embedding_dim))
+            first, last = self.row_offset, min(num_embeddings, self.row_offset + self.rows_per_rank)
+            for block_start in range(first - first % block_rows, last, block_rows):
+                generator = torch.Generator().manual_seed(seed * 1000003 + block_start // block_rows)
+                block = torch.randn((min(block_rows, num_embeddings - block_start), embedding_dim), generator=generator)
+                lo, hi = max(first, block_start), min(last, block_start + block.shape[0])
+                local[lo - first:hi - first] = block[lo - block_start:hi - block_start]
+            self.weight = torch.nn.Parameter(local)
+
+        def forward(self, indices):
+            return shardedLookup.apply(self.weight, indices, self.row_offset)
+
+        def full_weight(self):
+            """
+            Collective, returns the full table on rank 0 and None on the other ranks.
+            """
+            gathered = [torch.empty_like(self.weight) for _ in range(dist.get_world_size())] if dist.get_rank() == 0 else None
+            dist.gather(self.weight.detach(), gathered, dst=0)
+            return torch.cat(gathered)[:self.num_embeddings] if gathered is not None else None
+
+        def load_full_weight(self, weight):
+            """
+            Collective, scatters the rows of the full table given on rank 0 (None on the other ranks).
+            """
+            chunks = None
+            if dist.get_rank() == 0:
+                padded = weight.new_zeros((self.rows_per_rank * dist.get_world_size(), weight.shape[1]))
+                padded[:weight.shape[0]] = weight
+                chunks = list(padded.chunk(dist.get_world_size()))
+            dist.scatter(self.weight.data, chunks, src=0)
+
+    def shard(df, rank, shuffle):
+        # Equal shards, so every rank runs the same number of steps with the same batch sizes
+        n_rows = df.shape[0] // dist.get_world_size()
+        order = torch.randperm(df.shape[0], generator=torch.Generator().manual_seed(42)) if shuffle else torch.arange(df.shape[0])
+        return df.iloc[order[rank * n_rows:(rank + 1) * n_rows].numpy()]
+
+    os.environ['AWS_ACCESS_KEY_ID'] = AWS_ACCESS_KEY_ID
+    os.environ['AWS_SECRET_ACCESS_KEY'] = AWS_SECRET_ACCESS_KEY
+    os.environ['MLFLOW_S3_ENDPOINT_URL'] = MLFLOW_S3_ENDPOINT_URL
+    os.environ['MLFLOW_TRACKING_URI'] = mlflow_uri
+
+    if mlflow_run_id == "":
+        mlflow_run_id = None
+
+    if hot_reload_model_run_id == 'none':
+        hot_reload_model_run_id = None
+
+    def load_data():
+        return (pd.read_parquet(training_data.path, columns=['userId', 'movieId', 'rating']),
+                pd.read_pickle(testing_data.path))
+
+    def run(rank, world_size, result_path=None, data=None):
+        if result_path is not None:
+            os.environ['MASTER_ADDR'] = '127.0.0.1'
+            os.environ['MASTER_PORT'] = str(master_port)
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+        dist.init_process_group("gloo", rank=rank, world_size=world_size)
+
+        # Forked ranks share the frames read by the parent copy-on-write, a rank started on its own reads them
+        train_df, test_df = data if data is not None else load_data()
+        data = None
+        train_dataset = datasetReader(shard(train_df, rank, shuffle_training_data), dataset_name=f'train-{rank}')
+        test_dataset = datasetReader(shard(test_df, rank, shuffle_testing_data), dataset_name=f'test-{rank}')
+        del train_df, test_df
+
+        n_users = training_data_metadata['n_users']
+        n_items = training_data_metadata['n_items']
+
+        mlflow.set_tracking_uri(uri=mlflow_uri)
+        torch.manual_seed(42)
+        if shard_embeddings:
+            model = MatrixFactorization(n_users, n_items, n_factors=model_embedding_factors, hidden_dim=model_hidden_dims, dropout_rate=model_dropout_rate,
+                                        user_factors=shardedEmbedding(n_users+1, model_embedding_factors, seed=42),
+                                        item_factors=shardedEmbedding(n_items+1, model_embedding_factors, seed=43))
+        else:
+            model = MatrixFactorization(n_users, n_items, n_factors=model_embedding_factors, hidden_dim=model_hidden_dims, dropout_rate=model_dropout_rate)
+
+        def load_state_from_rank0(state):
+            """
+            Collective, copies a full MatrixFactorization state dict given on rank 0 (None on the other ranks)
+            into the model of every rank, scattering the rows of sharded tables.
+            """
+            with torch.no_grad():
+                for name, p in model.named_parameters():
+                    module = model.get_submodule(name.rsplit('.', 1)[0])
+                    if isinstance(module, shardedEmbedding):
+                        module.load_full_weight(state[name] if rank == 0 else None)
+                    else:
+                        if rank == 0:
+                            p.copy_(state[name])
+                        dist.broadcast(p.data, src=0)
+
+        if hot_reload_model_run_id:
+            # Only rank 0 loads the full model
+            state = None
+            if rank == 0:
+                state = mlflow.pytorch.load_model(f"runs:/{hot_reload_model_run_id}/model", map_location="cpu").state_dict()
+            load_state_from_rank0(state)
+            del state
+
+        if shard_embeddings:
+            head_parameters = [p for name, p in model.named_parameters() if not name.startswith(("user_factors.", "item_factors."))]
+            forward_model = model
+        else:
+            forward_model = DistributedDataParallel(model)
+
+        if mixed_precision not in ("none", "bf16"):
+            raise ValueError(f"Unsupported mixed_precision on CPU: {mixed_precision}")
+        autocast_dtype = torch.bfloat16 if mixed_precision == "bf16" else None
+
+        optimizer = torch.optim.SGD(model.parameters(), lr=model_learning_rate)
+        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=optimizer_step_size, gamma=optimizer_gamma)
+        loss_func = torch.nn.L1Loss()
+        loader_options = {}
+        if dataloader_workers > 0:
+            loader_options.update(num_workers=dataloader_workers, prefetch_factor=dataloader_prefetch_factor,
+                                  persistent_workers=True)
+        train_dataloader = DataLoader(train_dataset, batch_size=None,
+                                      sampler=batchSampler(len(train_dataset), train_batch_size, shuffle_training_data),
+                                      **loader_options)
+        test_dataloader = DataLoader(test_dataset, batch_size=None,
+                                     sampler=batchSampler(len(test_dataset), test_batch_size, shuffle_testing_data),
+                                     **loader_options)
+
+        def full_state_dict():
+            """
+            Collective, returns the full MatrixFactorization state dict on rank 0 and None on the other ranks.
+            """
+            state = {}
+            for name, p in model.named_parameters():
+                module = model.get_submodule(name.rsplit('.', 1)[0])
+                state[name] = module.full_weight() if isinstance(module, shardedEmbedding) else p.detach().clone()
+            return state if rank == 0 else None
+
+        def save_checkpoint(epoch):
+            state = full_state_dict()
+            if rank != 0:
+                return
+            # Ranks draw the same random numbers, so the RNG state of rank 0 is the one of every rank
+            checkpoint = {
+                "epoch": epoch,
+                "model": state,
+                "optimizers": [optimizer.state_dict()],
+                "schedulers": [scheduler.state_dict()],
+                "rng": torch.get_rng_state(),
+                "best_testing_loss": best_testing_loss,
+                "epochs_without_improvement": epochs_without_improvement,
+            }
+            checkpoint_dir = tempfile.mkdtemp()
+            torch.save(checkpoint, os.path.join(checkpoint_dir, "last.pt"))
+            mlflow.log_artifact(os.path.join(checkpoint_dir, "last.pt"), "checkpoints")
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+        current_run_id = ""
+        checkpoint = None
+        if rank == 0:
+            mlflow.set_experiment(mlflow_experiment_name)
+            current_run_id = mlflow.start_run(run_id=mlflow_run_id).info.run_id
+            # Same as train_model, the params of a resumed run are already logged and can not change
+            if mlflow_run_id is not None and mlflow.MlflowClient().list_artifacts(current_run_id, "checkpoints"):
+                checkpoint_path = mlflow.artifacts.download_artifacts(run_id=current_run_id, artifact_path="checkpoints/last.pt")
+                checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+            else:
+                for k, v in input_params.items():
+                    if 'mlflow_' not in k:
+                        mlflow.log_param(k, v)
+                mlflow.log_param("loss_function", loss_func.__class__.__name__)
+                mlflow.log_param("optimizer", "SGD")
+                mlflow.log_params({'n_user': n_users, 'n_items': n_items})
+                for k, v in mlflow_tags.items():
+                    mlflow.set_tag(k, v)
+
+        start_epoch = 0
+        best_testing_loss = float("inf")
+        epochs_without_improvement = 0
+        # Everything but the tables goes to the other ranks as an object, the tables are broadcast or scattered
+        resume_state = [None if checkpoint is None else {k: v for k, v in checkpoint.items() if k != "model"}]
+        dist.broadcast_object_list(resume_state, src=0)
+        resume_state = resume_state[0]
+        if resume_state is not None:
+            load_state_from_rank0(checkpoint["model"] if rank == 0 else None)
+            del checkpoint
+            optimizer.load_state_dict(resume_state["optimizers"][0])
+            scheduler.load_state_dict(resume_state["schedulers"][0])
+            torch.set_rng_state(resume_state["rng"])
+            best_testing_loss = resume_state["best_testing_loss"]
+            epochs_without_improvement = resume_state["epochs_without_improvement"]
+            start_epoch = resume_state["epoch"] + 1
+            print(f"Rank {rank} resuming from epoch {start_epoch}")
+            if early_stopping_patience > 0 and epochs_without_improvement >= early_stopping_patience:
+                # The interrupted run had already stopped early, only the model is left to log
+                start_epoch = training_epochs
+
+        for train_iter in range(start_epoch, training_epochs):
+            model.train()
+            t_loss = torch.zeros(())
+            t_count = 0
+            for row, col, rating in train_dataloader:
+                with torch.autocast(device_type="cpu", dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                    prediction = forward_model(row, col)
+                loss = loss_func(prediction.float(), rating.unsqueeze(1))
+                t_loss += loss.detach()
+                t_count += 1
+
+                loss.backward()
+                if shard_embeddings:
+                    # The sharded lookups already reduced the embedding gradients
+                    for p in head_parameters:
+                        dist.all_reduce(p.grad)
+                        p.grad /= dist.get_world_size()
+
+                optimizer.step()
+                optimizer.zero_grad()
+            scheduler.step()
+            model.eval()
+            te_loss = torch.zeros(())
+            te_count = 0
+            with torch.no_grad():
+                for row, col, rating in test_dataloader:
+                    with torch.autocast(device_type="cpu", dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                        prediction = model(row, col)
+                    te_loss += loss_func(prediction.float(), rating.unsqueeze(1))
+                    te_count += 1
+            losses = torch.stack([t_loss / t_count, te_loss / te_count])
+            dist.all_reduce(losses)
+            losses /= dist.get_world_size()
+            if rank == 0:
+                mlflow.log_metrics({"avg_training_loss": losses[0].item(), "avg_testing_loss": losses[1].item()}, step=train_iter)
+                print(f"{train_iter} Train loss: {losses[0].item()} Test loss: {losses[1].item()}")
+
+            # The losses are all_reduced, so every rank takes the same decision
+            if losses[1].item() < best_testing_loss - early_stopping_min_delta:
+                best_testing_loss = losses[1].item()
+                epochs_without_improvement = 0
+            else:
+                epochs_without_improvement += 1
+            stop = early_stopping_patience > 0 and epochs_without_improvement >= early_stopping_patience
+
+            if checkpoint_every_n_epochs > 0 and ((train_iter + 1) % checkpoint_every_n_epochs == 0 or stop):
+                save_checkpoint(train_iter)
+            if stop:
+                if rank == 0:
+                    print(f"No improvement of the testing loss in {epochs_without_improvement} epochs, stopping")
+                    mlflow.log_metric("early_stopping_epoch", train_iter)
+                break
+
+        if shard_embeddings:
+            # Collective, every rank has to take part before rank 0 rebuilds the plain embedding layers
+            user_weight = model.user_factors.full_weight()
+            item_weight = model.item_factors.full_weight()
+            if rank == 0:
+                model.user_factors = torch.nn.Embedding.from_pretrained(user_weight, freeze=False)
+                model.item_factors = torch.nn.Embedding.from_pretrained(item_weight, freeze=False)
+
+        if rank == 0:
+            model.eval()
+            row, col, _ = train_dataset[slice(0, min(len(train_dataset), train_batch_size))]
+            with torch.no_grad():
+                prediction = model(row, col)
+            model_signature = infer_signature({'user': row.numpy(), 'movie': col.numpy()}, prediction.numpy())
+            mlflow.pytorch.log_model(model, "model", signature=model_signature)
+            mlflow.end_run()
+            if result_path is not None:
+                with open(result_path, "w", encoding="utf-8") as f:
+                    f.write(current_run_id)
+
+        dist.barrier()
+        dist.destroy_process_group()
+        return current_run_id
+
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
+        return run(int(os.environ["RANK"]), int(os.environ["WORLD_SIZE"]))
+
+    # Fork, as the rank function and the classes above are local and can not be pickled for spawn
+    result_path = os.path.join(tempfile.mkdtemp(), "run_id")
+    # Read once in the parent, so the pod holds one copy of the data instead of one per rank
+    mp.start_processes(run, args=(world_size, result_path, load_data()), nprocs=world_size, start_method="fork")
+    with open(result_path, encoding="utf-8") as f:
+        return f.read()
@@ -11,7 +11,9 @@ def validate_model_cuda(
         AWS_ACCESS_KEY_ID: str,
         AWS_SECRET_ACCESS_KEY: str,
         MLFLOW_S3_ENDPOINT_URL: str,
-        validation_dataset: Input[Dataset]):
+        validation_dataset: Input[Dataset],
+        model_artifact_path: str = "model",
+        metric_prefix: str = ""):
 
     # https://pureai.substack.com/p/recommender-systems-with-pytorch
     from collections import defaultdict
@@ -19,7 +21,7 @@ def validate_model_cuda(
     import mlflow.pytorch
     import mlflow
     from sklearn.metrics import root_mean_squared_error
-    from torch.utils.data import DataLoader
+    from torch.utils.data import DataLoader, Dataset
     import pandas as pd
 
     import os
@@ -34,24 +36,49 @@ def validate_model_cuda(
     device = "cuda" if torch.cuda.is_available() else "cpu"
     print(f"Using device: {device}")
     
-    model_uri = f"runs:/{model_run_id}/model"
+    model_uri = f"runs:/{model_run_id}/{model_artifact_path}"
     recommendation_model = mlflow.pytorch.load_model(model_uri)
     class datasetReader(Dataset):
+        """
+        The validation split is converted once to contiguous tensors, so the rms pass gathers each
+        batch by index instead of reading pandas rows and collating samples one by one.
+        """
         def __init__(self, df, dataset_name):
             super().__init__()
-            self.df = df
             self.name = dataset_name
-            print(f"{self.name} : {self.df.shape[0]}")
+            self.users = torch.from_numpy(df['userId'].to_numpy(dtype='int64') - 1)
+            self.items = torch.from_numpy(df['movieId'].to_numpy(dtype='int64') - 1)
+            self.ratings = torch.from_numpy(df['rating'].to_numpy(dtype='float32'))
+            print(f"{self.name} : {self.users.shape[0]}")
 
         def __len__(self):
-            return self.df.shape[0]
+            return self.users.shape[0]
 
         def __getitem__(self, idx):
-            sd = self.df.iloc[idx]
-            user = sd['userId']
-            item = sd['movieId']
-            rating = sd['rating']
-            return torch.tensor(user-1).long(), torch.tensor(item-1).long(), torch.tensor(rating).float()
+            batch = self.users[idx], self.items[idx], self.ratings[idx]
+            if isinstance(idx, slice) and torch.utils.data.get_worker_info() is not None:
+                # A view would hand the whole column storage to the main process through shared memory
+                batch = tuple(t.clone() for t in batch)
+            return batch
+
+    class batchSampler:
+        """
+        Yields the indexes of a whole batch at a time, used with DataLoader(batch_size=None).
+        Unshuffled batches are slices, so they are views on the dataset tensors (copies in loader workers).
+        """
+        def __init__(self, n_rows, batch_size, shuffle):
+            self.n_rows = n_rows
+            self.batch_size = batch_size
+            self.shuffle = shuffle
+
+        def __len__(self):
+            return (self.n_rows + self.batch_size - 1) // self.batch_size
+
+        def __iter__(self):
+            order = torch.randperm(self.n_rows) if self.shuffle else None
+            for start in range(0, self.n_rows, self.batch_size):
+                end = min(start + self.batch_size, self.n_rows)
+                yield slice(start, end) if order is None else order[start:end]
 
     def calculate_precision_recall(user_ratings, k, threshold):
         user_ratings.sort(key=lambda x: x[0], reverse=True)
@@ -66,7 +93,8 @@ def validate_model_cuda(
     user_ratings_comparison = defaultdict(list)
 
     val_data = datasetReader(pd.read_pickle(validation_dataset.path), dataset_name='val')
-    val_dataloader = DataLoader(val_data, batch_size=val_batch_size, shuffle=True)
+    val_dataloader = DataLoader(val_data, batch_size=None,
+                                sampler=batchSampler(len(val_data), val_batch_size, True))
 
     y_pred = []
     y_true = []
@@ -103,6 +131,6 @@ def validate_model_cuda(
     print(f"precision_{k}: {average_precision:.4f}")
     print(f"recall_{k}: {average_recall:.4f}")
     print(f"rms: {rms:.4f}")
-    mlflow.log_metric(f"precision_{k}", average_precision, run_id=model_run_id)
-    mlflow.log_metric(f"recall_{k}", average_recall, run_id=model_run_id)
-    mlflow.log_metric("rms", rms, run_id=model_run_id)
+    mlflow.log_metric(f"{metric_prefix}precision_{k}", average_precision, run_id=model_run_id)
+    mlflow.log_metric(f"{metric_prefix}recall_{k}", average_recall, run_id=model_run_id)
+    mlflow.log_metric(f"{metric_prefix}rms", rms, run_id=model_run_id)
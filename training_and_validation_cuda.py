@@ -6,6 +6,9 @@ from training_and_validation_components import (
     negative_sampling_cuda, get_dataset_metadata_cuda,
     get_test_valid_dataset_cuda,
     promote_model_to_staging_cuda,
+    export_inference_model_cuda,
+    quantize_model_cuda,
+    precompute_recommendations_cuda,
     validate_model_cuda,
     train_model_cuda
 )
@@ -18,6 +21,8 @@ from training_and_validation_components import (
 def training_pipeline_cuda(
         minio_bucket: str = 'datasets',
         number_of_negative_samples: int = 10,
+        negative_sampling_seed: int = 42,
+        negative_sampling_popularity_exponent: float = 0.0,
         training_dataset_name: str = 'ml-25m',
         training_batch_size: int = 64,
         training_learning_rate: float = 0.001,
@@ -30,6 +35,17 @@ def training_pipeline_cuda(
         testing_batch_size: int = 64,
         shuffle_training_data: bool = True,
         shuffle_testing_data: bool = True,
+        dataloader_workers: int = 2,
+        dataloader_prefetch_factor: int = 2,
+        pin_memory: bool = True,
+        training_embedding_optimizer: str = 'dense',
+        training_metrics_log_every_n_steps: int = 100,
+        training_mixed_precision: str = 'none',
+        training_compile_model: bool = False,
+        training_checkpoint_every_n_epochs: int = 1,
+        training_early_stopping_patience: int = 0,
+        training_early_stopping_min_delta: float = 0.0,
+        training_mlflow_run_id: str = '',
         hot_reload_model_id: str = 'none',
         validation_top_k: int = 50,
         validation_threshold: int = 3,
@@ -37,6 +53,10 @@ def training_pipeline_cuda(
         model_promote_rms_threshold: float = 0.0001,
         model_promote_precision_threshold: float = -0.3,
         model_promote_recall_threshold: float = -0.2,
+        precompute_top_k: int = 100,
+        precompute_user_batch_size: int = 256,
+        export_block_elements: int = 4194304,
+        quantization_precision: str = 'int8',
         mlflow_experiment_name: str = 'recommender',
         mlflow_registered_model_name: str = 'recommender_production',
         mlflow_uri: str = 'http://mlflow-service.mlflow.svc.cluster.local:5000',
@@ -54,7 +74,9 @@ def training_pipeline_cuda(
                     bucket=minio_bucket,
                     dataset_name=training_dataset_name,
                     split='train', 
-                    num_ng_test=number_of_negative_samples).after(dataset_metadata).set_caching_options(True)
+                    num_ng_test=number_of_negative_samples,
+                    seed=negative_sampling_seed,
+                    popularity_exponent=negative_sampling_popularity_exponent).after(dataset_metadata).set_caching_options(True)
 
     aux_data = get_test_valid_dataset_cuda(
                 bucket=minio_bucket,
@@ -62,7 +84,7 @@ def training_pipeline_cuda(
 
     training = train_model_cuda(
         mlflow_experiment_name=mlflow_experiment_name,
-        mlflow_run_id="",
+        mlflow_run_id=training_mlflow_run_id,
         mlflow_tags={},
         hot_reload_model_run_id=hot_reload_model_id,
         model_embedding_factors=model_embedding_factors,
@@ -79,6 +101,16 @@ def training_pipeline_cuda(
         testing_data=aux_data.outputs['testing_dataset'],
         shuffle_training_data=shuffle_training_data,
         shuffle_testing_data=shuffle_testing_data,
+        dataloader_workers=dataloader_workers,
+        dataloader_prefetch_factor=dataloader_prefetch_factor,
+        pin_memory=pin_memory,
+        embedding_optimizer=training_embedding_optimizer,
+        metrics_log_every_n_steps=training_metrics_log_every_n_steps,
+        mixed_precision=training_mixed_precision,
+        compile_model=training_compile_model,
+        checkpoint_every_n_epochs=training_checkpoint_every_n_epochs,
+        early_stopping_patience=training_early_stopping_patience,
+        early_stopping_min_delta=training_early_stopping_min_delta,
         mlflow_uri=mlflow_uri,
         AWS_ACCESS_KEY_ID=AWS_ACCESS_KEY_ID, 
         AWS_SECRET_ACCESS_KEY=AWS_SECRET_ACCESS_KEY, 
@@ -97,7 +129,7 @@ def training_pipeline_cuda(
         MLFLOW_S3_ENDPOINT_URL=MLFLOW_S3_ENDPOINT_URL,
         mlflow_uri=mlflow_uri).after(training).set_caching_options(True)
 
-    promote_model_to_staging_cuda(
+    promote = promote_model_to_staging_cuda(
         model_run_id=training.output,
         registered_model_name=mlflow_registered_model_name,
         top_k=validation_top_k,
@@ -109,6 +141,47 @@ def training_pipeline_cuda(
         MLFLOW_S3_ENDPOINT_URL=MLFLOW_S3_ENDPOINT_URL,
         mlflow_uri=mlflow_uri).after(val).set_caching_options(False)
 
+    export_inference_model_cuda(
+        model_run_id=training.output,
+        block_elements=export_block_elements,
+        AWS_ACCESS_KEY_ID=AWS_ACCESS_KEY_ID, 
+        AWS_SECRET_ACCESS_KEY=AWS_SECRET_ACCESS_KEY, 
+        MLFLOW_S3_ENDPOINT_URL=MLFLOW_S3_ENDPOINT_URL,
+        mlflow_uri=mlflow_uri).after(val).set_caching_options(False)
+
+    quantization = quantize_model_cuda(
+        model_run_id=training.output,
+        precision=quantization_precision,
+        AWS_ACCESS_KEY_ID=AWS_ACCESS_KEY_ID, 
+        AWS_SECRET_ACCESS_KEY=AWS_SECRET_ACCESS_KEY, 
+        MLFLOW_S3_ENDPOINT_URL=MLFLOW_S3_ENDPOINT_URL,
+        mlflow_uri=mlflow_uri).after(training).set_caching_options(False)
+
+    # Same metrics as the float model, logged with a quantized_ prefix for the accuracy report
+    validate_model_cuda(
+        model_run_id=training.output,
+        top_k=validation_top_k,
+        threshold=validation_threshold,
+        val_batch_size=validation_batch_size,
+        validation_dataset=aux_data.outputs['validation_dataset'],
+        model_artifact_path='quantized_model',
+        metric_prefix='quantized_',
+        AWS_ACCESS_KEY_ID=AWS_ACCESS_KEY_ID, 
+        AWS_SECRET_ACCESS_KEY=AWS_SECRET_ACCESS_KEY, 
+        MLFLOW_S3_ENDPOINT_URL=MLFLOW_S3_ENDPOINT_URL,
+        mlflow_uri=mlflow_uri).after(quantization).set_caching_options(False)
+
+    # Only a promoted model is worth scoring every user against the whole catalogue
+    with dsl.If(promote.output == True, name='model-promoted'):
+        precompute_recommendations_cuda(
+            model_run_id=training.output,
+            top_k=precompute_top_k,
+            user_batch_size=precompute_user_batch_size,
+            AWS_ACCESS_KEY_ID=AWS_ACCESS_KEY_ID, 
+            AWS_SECRET_ACCESS_KEY=AWS_SECRET_ACCESS_KEY, 
+            MLFLOW_S3_ENDPOINT_URL=MLFLOW_S3_ENDPOINT_URL,
+            mlflow_uri=mlflow_uri).after(promote).set_caching_options(False)
+
 
 if __name__ == "__main__":
     kfp.compiler.Compiler().compile(
@@ -0,0 +1,146 @@
+import argparse
+import json
+import time
+
+import torch
+
+
+class MatrixFactorization(torch.nn.Module):
+    """
+    Same layout as the model trained by train_model, with random weights.
+    """
+    def __init__(self, n_users, n_items, n_factors, hidden_dim, dropout_rate):
+        super().__init__()
+        self.n_items = n_items
+        self.user_factors = torch.nn.Embedding(n_users+1, n_factors, sparse=False)
+        self.item_factors = torch.nn.Embedding(n_items+1, n_factors, sparse=False)
+        self.linear = torch.nn.Linear(in_features=n_factors, out_features=hidden_dim)
+        self.linear2 = torch.nn.Linear(in_features=hidden_dim, out_features=1)
+        self.dropout = torch.nn.Dropout(p=dropout_rate)
+        self.relu = torch.nn.ReLU()
+
+    def forward(self, user, item):
+        user_embedding = self.user_factors(user)
+        item_embedding = self.item_factors(item)
+        embeddding_vector = torch.mul(user_embedding, item_embedding)
+        x = self.relu(self.linear(embeddding_vector))
+        x = self.dropout(x)
+        rating = self.linear2(x)
+        return rating
+
+
+def build_optimizers(model, embedding_optimizer, learning_rate):
+    """
+    Optimizers as set up by train_model for the given embedding_optimizer.
+    """
+    sparse_embeddings = embedding_optimizer != "dense"
+    model.user_factors.sparse = sparse_embeddings
+    model.item_factors.sparse = sparse_embeddings
+    if embedding_optimizer == "sparse_adam":
+        embedding_parameters = [model.user_factors.weight, model.item_factors.weight]
+        head_parameters = [p for name, p in model.named_parameters() if not name.startswith(("user_factors.", "item_factors."))]
+        return [torch.optim.SparseAdam(embedding_parameters, lr=learning_rate),
+                torch.optim.SGD(head_parameters, lr=learning_rate)]
+    return [torch.optim.SGD(model.parameters(), lr=learning_rate)]
+
+
+def tensor_bytes(tensor):
+    if tensor.is_sparse:
+        tensor = tensor.coalesce()
+        return tensor_bytes(tensor.indices()) + tensor_bytes(tensor.values())
+    return tensor.numel() * tensor.element_size()
+
+
+def gradient_bytes(model):
+    return sum(tensor_bytes(p.grad) for p in model.parameters() if p.grad is not None)
+
+
+def optimizer_state_bytes(optimizers):
+    return sum(tensor_bytes(v) for optimizer in optimizers for state in optimizer.state.values()
+               for v in state.values() if isinstance(v, torch.Tensor))
+
+
+def benchmark(embedding_optimizer, n_users, n_items, n_factors, hidden_dim, batch_size, steps, warmup, device,
+              mixed_precision="none", compile_model=False, learning_rate=0.001, seed=42):
+    """
+    Time training steps on random batches.
+    :param mixed_precision: str, "none", "bf16" or "fp16" (GPU only, with gradient scaling) autocast
+    :return: dict with the mean step time, samples/sec, final loss and the size of gradients and optimizer state
+    """
+    torch.manual_seed(seed)
+    model = MatrixFactorization(n_users, n_items, n_factors, hidden_dim, dropout_rate=0.2).to(device)
+    model.train()
+    optimizers = build_optimizers(model, embedding_optimizer, learning_rate)
+    loss_func = torch.nn.L1Loss()
+    autocast_dtype = {"none": None, "bf16": torch.bfloat16, "fp16": torch.float16}[mixed_precision]
+    scaler = torch.amp.GradScaler("cuda", enabled=mixed_precision == "fp16")
+    forward_model = torch.compile(model) if compile_model else model
+
+    users = torch.randint(0, n_users, (steps + warmup, batch_size), device=device)
+    items = torch.randint(0, n_items, (steps + warmup, batch_size), device=device)
+    ratings = torch.rand((steps + warmup, batch_size), device=device) * 4.5 + 0.5
+
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    for step in range(steps + warmup):
+        if step == warmup:
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        with torch.autocast(device_type=device, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+            prediction = forward_model(users[step], items[step])
+        loss = loss_func(prediction.float(), ratings[step].unsqueeze(1))
+        scaler.scale(loss).backward()
+        grad_bytes = gradient_bytes(model) if step == steps + warmup - 1 else None
+        for optimizer in optimizers:
+            scaler.step(optimizer)
+        scaler.update()
+        for optimizer in optimizers:
+            optimizer.zero_grad()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "embedding_optimizer": embedding_optimizer,
+        "mixed_precision": mixed_precision,
+        "compile_model": compile_model,
+        "step_ms": 1000 * elapsed / steps,
+        "samples_per_second": steps * batch_size / elapsed,
+        "final_loss": loss.item(),
+        "gradient_bytes": grad_bytes,
+        "optimizer_state_bytes": optimizer_state_bytes(optimizers),
+    }
+    if device == "cuda":
+        result["peak_memory_bytes"] = torch.cuda.max_memory_allocated()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Step time and memory of MatrixFactorization training configurations")
+    parser.add_argument("--embedding-optimizers", nargs="+", default=["dense", "sparse_sgd", "sparse_adam"])
+    parser.add_argument("--n-users", type=int, default=162541)
+    parser.add_argument("--n-items", type=int, default=209171)
+    parser.add_argument("--n-factors", type=int, default=20)
+    parser.add_argument("--hidden-dim", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--mixed-precision", default="none", choices=["none", "bf16", "fp16"])
+    parser.add_argument("--compile", action="store_true", help="run the forward pass through torch.compile")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'optimizer':>12} {'step ms':>9} {'samples/s':>11} {'loss':>7} {'grad MB':>9} {'state MB':>9}")
+    for embedding_optimizer in args.embedding_optimizers:
+        result = benchmark(embedding_optimizer, args.n_users, args.n_items, args.n_factors, args.hidden_dim,
+                           args.batch_size, args.steps, args.warmup, args.device, args.mixed_precision, args.compile)
+        results.append(result)
+        print(f"{embedding_optimizer:>12} {result['step_ms']:>9.3f} {result['samples_per_second']:>11.0f} {result['final_loss']:>7.3f} "
+              f"{result['gradient_bytes'] / 2**20:>9.2f} {result['optimizer_state_bytes'] / 2**20:>9.2f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)